@@ -1,15 +1,35 @@
 import os
 import random
 import re
-from typing import Dict, Any, List, Union
+import time
+from typing import Dict, Any, List, Optional, Union
 from dataclasses import dataclass
 
 import streamlit as st
-from langchain_core.runnables import RunnableWithMessageHistory
+from langchain_core.messages import AIMessageChunk, HumanMessage, AIMessage, SystemMessage
+from langchain_core.runnables import RunnableGenerator, RunnableWithMessageHistory
 from langchain.prompts.chat import ChatPromptTemplate, MessagesPlaceholder
-from langchain_community.chat_message_histories import StreamlitChatMessageHistory
+from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.prompt_values import ChatPromptValue
 from langchain_aws import ChatBedrockConverse
 from models import MODELS  # <--- import MODELS here
+import telemetry
+from routing import ROUTER, endpoint_url_for, regions_from_env
+from rendering import RenderCoalescer
+from tools import get_tools, run_tool_calls
+from singleflight import SINGLE_FLIGHT, SINGLE_FLIGHT_ENABLED, fingerprint
+from background import TurnBuffer, start_worker
+from branching import ConversationTree
+import longinput
+import profiling
+from images import (
+    DEFAULT_MAX_EDGE, DEFAULT_MAX_PIXELS, IMAGE_MAX_COUNT, IMAGE_TURN_BUDGET, IMAGE_TYPES, fit_turn_budget,
+    get_image, image_blocks
+)
+from token_budget import ADAPTIVE_MAX_TOKENS, CONTINUATIONS, MAX_CONTINUATIONS, OUTPUT_LENGTHS, record_reservation
+from translation_memory import (
+    AUTO_DETECT, LANGUAGES, TRANSLATION_MEMORY, build_batch_prompt, format_stats, parse_batch_response
+)
 
 # AWS credentials are expected to be set by saml2aws (in ~/.aws/credentials)
 # Optionally, you can set AWS_DEFAULT_REGION in your environment or .env file
@@ -84,7 +104,28 @@ Provide detailed, data-driven analysis with clear recommendations. Always includ
         • 📉 Cross-channel performance comparison
         
         What performance data needs analysis today?
-        """
+        """,
+        "tools": ["list_tables", "run_sql", "compute_metrics"],
+        "long_input": {
+            "map": """The user's input is too long to analyze at once and has been split into {total} parts. The input begins with:
+
+{request}
+
+Here is part {index} of {total}:
+
+{part}
+
+Extract the key metrics, trends, anomalies and notable figures from this part only, as concise bullet points with the exact numbers. Do not write recommendations yet.""",
+            "reduce": """The user's input was too long to analyze at once, so it was split into {total} parts and each part was analyzed separately. The input begins with:
+
+{request}
+
+Partial analyses, in order:
+
+{results}
+
+Combine the partial analyses into one data-driven answer to the user's request: overall KPIs, trends, anomalies and clear, actionable recommendations."""
+        }
     },
     "Ad Operations Expert": {
         "prompt": """You are an Ad Operations specialist with comprehensive knowledge of ad serving, trafficking, and technical implementation. Your expertise covers:
@@ -168,7 +209,8 @@ Provide optimized SQL queries with clear explanations. Focus on Snowflake best p
         • 💰 Cost optimization and resource management
         
         What data challenge can I help you solve?
-        """
+        """,
+        "tools": ["list_tables", "run_sql"]
     },
     "Translator": {
         "prompt": "You are a professional translator. Please identify the source language and translate to the target language while preserving meaning, tone, and nuance. Ensure proper grammar and formatting.",
@@ -184,7 +226,9 @@ Provide optimized SQL queries with clear explanations. Focus on Snowflake best p
         • 🗣️ Natural language flow
         
         What would you like me to translate today?
-        """
+        """,
+        "translation_memory": True,
+        "output_scales_with_input": True
     },
     "Writing Assistant": {
         "prompt": """You are an AI writing assistant. Your task is to improve written content by:
@@ -209,7 +253,30 @@ Keep feedback constructive and insightful.""",
         • 📝 Content editing and refinement
         
         What writing project can I help you improve?
-        """
+        """,
+        "output_scales_with_input": True,
+        "long_input": {
+            "map": """The user's text is too long to edit at once and has been split into {total} parts. The text begins with:
+
+{request}
+
+Here is part {index} of {total}:
+
+{part}
+
+Edit this part only. Output the fully edited part first, then a line containing only ===NOTES===, then a short bullet list of the main issues you fixed.""",
+            "reduce": """The user's text was too long to edit at once, so it was split into {total} parts and each part was edited separately. The edited text has already been shown to the user. The text begins with:
+
+{request}
+
+Notes on the issues fixed in each part, in order:
+
+{results}
+
+Write the overall feedback: the main issues across the whole text and suggestions for flow and organization. Do not repeat the edited text.""",
+            # Edited parts are streamed as they are ready; only the notes are reduced
+            "stream_parts": True
+        }
     },
     "Custom": {
         "prompt": "",
@@ -229,6 +296,12 @@ Keep feedback constructive and insightful.""",
     }
 }
 
+# Maximum model/tool round trips in one turn before the answer is cut off
+MAX_TOOL_ROUNDS = 8
+
+# Bedrock prompt cache checkpoint (Converse content block)
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
 # Backward compatibility - extract prompts for existing code
 ROLE_PROMPTS = {role: config["prompt"] for role, config in ROLE_CONFIG.items()}
 
@@ -239,16 +312,21 @@ def get_role_greeting(role_name: str) -> str:
 
 @dataclass
 class ChatModel:
-    """Simplified chat model class"""
+    """Simplified chat model class with a pool of Bedrock regions and optional tools"""
     model_name: str
     model_kwargs: Dict[str, Any]
+    regions: Optional[List[str]] = None
+    tools: Optional[List[str]] = None
+    role: str = "Default"
+    # Size max_tokens per request from observed answer lengths (max_tokens becomes the upper limit)
+    adaptive_max_tokens: bool = False
     
     def __post_init__(self):
         model_config = MODELS[self.model_name]
         self.model_id = model_config["model_id"]
         
         # Basic parameters
-        base_kwargs = {
+        self.base_kwargs = {
             "model": self.model_id,
             "temperature": self.model_kwargs.get("temperature", model_config["temperature"]),
             "top_p": self.model_kwargs.get("top_p", model_config["top_p"]),
@@ -257,11 +335,119 @@ class ChatModel:
         
         # Add top_k configuration
         if "anthropic" in self.model_id:
-            base_kwargs["additional_model_request_fields"] = {
+            self.base_kwargs["additional_model_request_fields"] = {
                 "top_k": self.model_kwargs.get("top_k", model_config["top_k"])
             }
         
-        self.llm = ChatBedrockConverse(**base_kwargs)
+        # Region pool: explicit argument, then BEDROCK_REGIONS, then the model default
+        self.regions = self.regions or regions_from_env() or model_config.get("regions") or [None]
+        self.prompt_cache = model_config.get("prompt_cache", False)
+        self.tool_objects = get_tools(self.tools)
+        self._llms = {}
+        self.llm = RunnableGenerator(self._stream)
+    
+    def get_llm(self, region: Optional[str]) -> ChatBedrockConverse:
+        """Create the Bedrock client for a region on first use"""
+        if region not in self._llms:
+            kwargs = dict(self.base_kwargs, region_name=region)
+            if endpoint_url := endpoint_url_for(region):
+                kwargs["endpoint_url"] = endpoint_url
+            llm = ChatBedrockConverse(**kwargs)
+            self._llms[region] = llm.bind_tools(self.tool_objects) if self.tool_objects else llm
+        return self._llms[region]
+    
+    def _stream(self, inputs):
+        """Stream each prompt, sharing the generation with identical in-flight requests"""
+        for prompt in inputs:
+            messages = prompt.to_messages()
+            if self.prompt_cache:
+                messages = cache_system_prompt(messages)
+            query_tokens = longinput.estimate_tokens(longinput.message_text(messages[-1])) if messages else 0
+            max_tokens = None
+            if self.adaptive_max_tokens:
+                max_tokens = OUTPUT_LENGTHS.predict(
+                    self.role, self.model_name, query_tokens, self.base_kwargs["max_tokens"],
+                    scales_with_input=ROLE_CONFIG.get(self.role, {}).get("output_scales_with_input", False)
+                )
+            if not SINGLE_FLIGHT_ENABLED:
+                yield from self._generate(messages, query_tokens, max_tokens)
+                continue
+            key = fingerprint(self.model_id, self.base_kwargs, max_tokens, [t.name for t in self.tool_objects],
+                              messages)
+            yield from SINGLE_FLIGHT.stream(key, lambda: self._generate(messages, query_tokens, max_tokens))
+    
+    def _generate(self, messages, query_tokens: int = 0, max_tokens: Optional[int] = None):
+        """Route the prompt to the healthiest region, running any tool calls in between"""
+        # Runs on the single-flight producer thread: include it in the turn's profile
+        with profiling.attach_thread():
+            output_tokens = 0
+            for _ in range(MAX_TOOL_ROUNDS):
+                message = None
+                for chunk in self._complete(messages, max_tokens):
+                    message = chunk if message is None else message + chunk
+                    yield chunk
+                if message is not None and message.usage_metadata:
+                    output_tokens += message.usage_metadata.get("output_tokens", 0)
+                if not self.tool_objects or message is None or not message.tool_calls:
+                    break
+                results = run_tool_calls(message.tool_calls, self.tool_objects)
+                # Show tool activity in the collapsible reasoning block (kept out of chat history)
+                yield AIMessageChunk(content=[{
+                    "type": "reasoning_content",
+                    "reasoning_content": {"text": format_tool_activity(message.tool_calls, results)},
+                }])
+                messages = messages + [message, *results]
+            # Every answer trains the budget model, so switching adaptive mode on starts informed
+            OUTPUT_LENGTHS.observe(self.role, self.model_name, query_tokens, output_tokens)
+    
+    def _complete(self, messages, max_tokens: Optional[int] = None):
+        """Stream one model reply; with an adaptive budget, continue it with assistant prefill
+        while it stops at max_tokens, up to the configured limit in total"""
+        limit = self.base_kwargs["max_tokens"]
+        kwargs = {"max_tokens": max_tokens} if max_tokens else {}
+        prompt = messages
+        text = ""
+        reserved = 0
+        try:
+            for _ in range(MAX_CONTINUATIONS + 1):
+                reserved += kwargs.get("max_tokens", limit)
+                stop_reason = None
+                tool_use = False
+                for chunk in ROUTER.stream(self.model_id, self.regions, self.get_llm, prompt, **kwargs):
+                    stop_reason = chunk.response_metadata.get("stopReason", stop_reason)
+                    tool_use = tool_use or bool(chunk.tool_call_chunks)
+                    text += longinput.message_text(chunk)
+                    yield chunk
+                if not kwargs or stop_reason != "max_tokens" or tool_use or not text.strip() or reserved >= limit:
+                    return
+                CONTINUATIONS.inc(model=self.model_id)
+                # Bedrock rejects a prefilled assistant turn that ends in whitespace
+                prompt = messages + [AIMessage(content=text.rstrip())]
+                kwargs = {"max_tokens": min(limit - reserved, kwargs["max_tokens"] * 2)}
+        finally:
+            record_reservation(self.model_id, reserved, limit)
+
+
+def cache_system_prompt(messages: List[Any]) -> List[Any]:
+    """Add a prompt cache checkpoint after the system prompt"""
+    if messages and isinstance(messages[0], SystemMessage) and isinstance(messages[0].content, str) \
+            and messages[0].content.strip():
+        system = SystemMessage(content=[{"type": "text", "text": messages[0].content}, CACHE_POINT])
+        return [system, *messages[1:]]
+    return messages
+
+
+def format_tool_activity(tool_calls: List[Dict[str, Any]], results: List[Any]) -> str:
+    """Summarize executed tool calls for display"""
+    lines = []
+    for call, result in zip(tool_calls, results):
+        args = ", ".join(f"{k}={v!r}" for k, v in (call.get("args") or {}).items())
+        if result.status == "success":
+            status = f"✅ {len(result.content.splitlines())} lines returned"
+        else:
+            status = f"⚠️ {result.content}"
+        lines.append(f"\n🔧 {call['name']}({args})\n{status}\n")
+    return "".join(lines)
 
 
 def set_page_config():
@@ -567,6 +753,8 @@ def render_sidebar():
         # Create role buttons in a 3-column grid
         cols = st.columns(3)
         role_keys = list(role_config.keys())
+        # Switching roles starts a new conversation; wait for the current answer instead of dropping it
+        generating = "active_turn" in st.session_state
         
         for i, role_key in enumerate(role_keys):
             with cols[i % 3]:
@@ -578,7 +766,8 @@ def render_sidebar():
                     key=f"role_{role_key}_{st.session_state.get('widget_key', 'default')}",
                     use_container_width=True,
                     help=f"Switch to {role_key} mode",
-                    type="primary" if is_selected else "secondary"
+                    type="primary" if is_selected else "secondary",
+                    disabled=generating and not is_selected
                 ):
                     # Check if role is changing
                     if st.session_state.selected_role != role_key:
@@ -590,6 +779,8 @@ def render_sidebar():
                     
                     st.session_state.selected_role = role_key
                     st.rerun()
+        if generating:
+            st.caption("⏳ Roles can be switched once the current answer is complete.")
         
         role = st.session_state.selected_role
         
@@ -607,6 +798,36 @@ def render_sidebar():
             help="Define how the AI should behave and respond"
         )
         
+        # Language pair for the Translator (also the translation memory key)
+        source_lang = target_lang = None
+        use_translation_memory = False
+        if ROLE_CONFIG.get(role, {}).get("translation_memory"):
+            st.markdown("#### 🌐 Languages")
+            col1, col2 = st.columns(2)
+            with col1:
+                source_lang = st.selectbox(
+                    "From",
+                    [AUTO_DETECT] + LANGUAGES,
+                    key=f"{st.session_state.get('widget_key', 'default')}_source_lang"
+                )
+            with col2:
+                target_lang = st.selectbox(
+                    "To",
+                    LANGUAGES,
+                    index=LANGUAGES.index("Traditional Chinese"),
+                    key=f"{st.session_state.get('widget_key', 'default')}_target_lang"
+                )
+            if TRANSLATION_MEMORY.enabled:
+                use_translation_memory = st.toggle(
+                    "📚 Translate with memory",
+                    value=True,
+                    help="Every message is translated segment by segment, without the conversation history. "
+                         "Switch off to ask follow-ups (e.g. \"make it more formal\") as a normal chat.",
+                    key=f"{st.session_state.get('widget_key', 'default')}_translation_memory"
+                )
+                st.caption(f"📚 Translation memory: {TRANSLATION_MEMORY.size(source_lang, target_lang):,} "
+                           f"segments for this language pair")
+        
         # Model parameters with enhanced styling
         st.markdown("#### ⚙️ Advanced Settings")
         
@@ -657,6 +878,14 @@ def render_sidebar():
                     help=f"Maximum response length (Model limit: {model_max_tokens:,})"
                 )
             
+            adaptive_max_tokens = st.toggle(
+                "🎚️ Adaptive Max Tokens",
+                value=ADAPTIVE_MAX_TOKENS,
+                key=f"{st.session_state.get('widget_key', 'default')}_adaptive_max_tokens",
+                help="Size max_tokens per request from observed answer lengths, up to the limit above, "
+                     "and continue answers that stop at it. Reserves less Bedrock quota per request."
+            )
+            
             # Current settings summary
             st.markdown(f"""
             <div class="parameter-section">
@@ -665,11 +894,14 @@ def render_sidebar():
                     🌡️ Temperature: {temperature}<br>
                     🎯 Top-P: {top_p}<br>
                     🔢 Top-K: {top_k}<br>
-                    📊 Max Tokens: {max_tokens:,}
+                    📊 Max Tokens: {max_tokens:,}{" (adaptive)" if adaptive_max_tokens else ""}
                 </div>
             </div>
             """, unsafe_allow_html=True)
         
+        if adaptive_max_tokens and st.session_state.get("reserved_tokens_saved"):
+            st.caption(f"💾 Reserved quota saved this session: {st.session_state.reserved_tokens_saved:,} tokens")
+        
         # Action buttons with enhanced styling
         st.markdown("---")
         st.markdown("#### 🚀 Actions")
@@ -687,22 +919,32 @@ def render_sidebar():
     
     return {
         "model_name": model_name,
+        "role": role,
         "system_prompt": system_prompt,
+        "source_lang": source_lang,
+        "target_lang": target_lang,
+        "use_translation_memory": use_translation_memory,
         "temperature": temperature,
         "top_p": top_p,
         "top_k": top_k,
-        "max_tokens": max_tokens
+        "max_tokens": max_tokens,
+        "adaptive_max_tokens": adaptive_max_tokens
     }
 
 
 def extract_reasoning_and_text(input_stream):
     """Process streaming responses and extract reasoning content"""
     in_reasoning_block = False
-    current_text = ""
     display_text = ""
+    turn = telemetry.current_turn()
     
     for chunk in input_stream:
         content = chunk.content if hasattr(chunk, "content") else chunk
+        if turn:
+            turn.chunk_received()
+            turn.record_usage(getattr(chunk, "usage_metadata", None))
+            if content:
+                turn.token_received()
         
         if isinstance(content, list):
             for item in content:
@@ -710,8 +952,10 @@ def extract_reasoning_and_text(input_stream):
                     reasoning_text = item.get("reasoning_content", {}).get("text", "")
                     if reasoning_text:
                         if not in_reasoning_block:
-                            display_text += "```thinking\n"
-                            yield "```thinking\n"
+                            # Fences only open at the start of a line
+                            opening = "```thinking\n" if not display_text or display_text.endswith("\n") else "\n```thinking\n"
+                            display_text += opening
+                            yield opening
                             in_reasoning_block = True
                         display_text += reasoning_text
                         yield reasoning_text
@@ -721,7 +965,6 @@ def extract_reasoning_and_text(input_stream):
                         yield "\n```\n"
                         in_reasoning_block = False
                     display_text += text
-                    current_text += text
                     yield text
         else:
             if in_reasoning_block:
@@ -729,40 +972,52 @@ def extract_reasoning_and_text(input_stream):
                 yield "\n```\n"
                 in_reasoning_block = False
             display_text += content
-            current_text += content
             yield content
     
     if in_reasoning_block:
-        display_text += "\n```"
         yield "\n```"
-    
-    # Store cleaned text
-    st.session_state["current_llm_text"] = current_text
-    st.session_state["current_display_text"] = display_text
 
 
-def store_message(role: str, content: str):
-    """Store message in session state"""
-    message = {"role": role}
-    
-    if role == "assistant" and "current_display_text" in st.session_state:
-        message["content"] = st.session_state["current_display_text"]
-        if "current_llm_text" in st.session_state:
-            message["llm_content"] = st.session_state["current_llm_text"]
-    else:
-        message["content"] = content
-        if role == "user":
-            message["llm_content"] = re.sub(r'```thinking.*?```', '', content, flags=re.DOTALL)
-        else:
-            message["llm_content"] = content
+def store_message(role: str, content: str, parent: Optional[str] = None, caption: Optional[str] = None,
+                  images: Optional[List[str]] = None, error: Optional[str] = None):
+    """Store message in the conversation tree (under `parent`, default the current branch)"""
+    message = {
+        "role": role,
+        "content": content,
+        "llm_content": re.sub(r'```thinking.*?```', '', content, flags=re.DOTALL).strip(),
+    }
+    if caption:
+        message["caption"] = caption
+    if images:
+        # Content hashes of attachments in the session image cache
+        message["images"] = images
+    if error:
+        # Shown with the (possibly partial) answer; never sent to the model
+        message["error"] = error
     
-    st.session_state.messages.append(message)
+    tree = st.session_state.conversation_tree
+    tree.append(message, parent)
+    st.session_state.messages = tree.path()
+
+
+def reset_conversation(role_name: str):
+    """Start a new conversation tree with the role-specific greeting"""
+    greeting_msg = get_role_greeting(role_name)
+    tree = ConversationTree({
+        "role": "assistant",
+        "content": greeting_msg,
+        "llm_content": f"Hello! I'm your {role_name} AI assistant. How can I help you today?"
+    })
+    st.session_state.conversation_tree = tree
+    st.session_state.messages = tree.path()
 
 
 def init_conversation(system_prompt: str, chat_model: ChatModel):
     """Initialize conversation chain"""
-    msgs = StreamlitChatMessageHistory()
-    msgs.clear()
+    # Plain in-memory history so background workers never touch st.session_state
+    if "msgs" not in st.session_state:
+        st.session_state.msgs = InMemoryChatMessageHistory()
+    msgs = st.session_state.msgs
     
     conversation = (
         RunnableWithMessageHistory(
@@ -780,53 +1035,238 @@ def init_conversation(system_prompt: str, chat_model: ChatModel):
     )
     
     # Initialize session state with role-specific greeting
-    if "messages" not in st.session_state:
-        current_role = st.session_state.get("selected_role", "Default")
-        greeting_msg = get_role_greeting(current_role)
-        st.session_state.messages = [{
-            "role": "assistant",
-            "content": greeting_msg,
-            "llm_content": f"Hello! I'm your {current_role} AI assistant. How can I help you today?"
-        }]
-    
-    if "current_llm_text" not in st.session_state:
-        st.session_state.current_llm_text = ""
-    
-    if "msgs" not in st.session_state:
-        st.session_state.msgs = msgs
+    if "conversation_tree" not in st.session_state:
+        reset_conversation(st.session_state.get("selected_role", "Default"))
     
     return conversation
 
 
-def generate_response(conversation, user_input: str):
-    """Generate response"""
+def generate_response(conversation, user_input: str, model_name: str = "unknown",
+                      chat_model: Optional[ChatModel] = None, system_prompt: str = "",
+                      languages: Optional[tuple] = None) -> TurnBuffer:
+    """Start generating the response in a background worker owned by the session"""
+    role = st.session_state.get("selected_role", "Default")
+    history = list(st.session_state.messages[:-1])
     msgs = st.session_state.msgs
-    msgs.clear()
+    tree = st.session_state.conversation_tree
     
-    # Add history messages (excluding current user message)
-    for i, msg in enumerate(st.session_state.messages[:-1]):
-        if i == 0:  # Skip initial greeting
-            continue
+    # Cache checkpoints at the end of the history and at the last fork, so sibling
+    # branches (edits, regenerations) reuse the Bedrock prompt cache for their shared prefix
+    cache_ids = set()
+    if MODELS.get(model_name, {}).get("prompt_cache") and len(history) > 1:
+        cache_ids = {history[-1]["id"], tree.last_fork()} - {None, tree.root}
+    
+    # Attachments: the current message's images plus as many history images as fit the turn budget
+    user_images = st.session_state.messages[-1].get("images", [])
+    history_images = [image_id for msg in history for image_id in msg.get("images", [])]
+    image_urls = {}
+    if user_images or history_images:
+        image_urls = fit_turn_budget(st.session_state.get("image_cache", {}), user_images, history_images)
+    
+    buffer = TurnBuffer(model_name, role)
+    buffer.parent_id = tree.leaf
+    st.session_state["active_turn"] = buffer
+    
+    # Translator turns go through the translation memory instead of the chat chain
+    if languages and chat_model and TRANSLATION_MEMORY.enabled and ROLE_CONFIG.get(role, {}).get("translation_memory"):
+        produce = lambda: stream_translation(chat_model, system_prompt, user_input, buffer, languages)
+    else:
+        # Oversized inputs are split and mapped in parallel before the streamed reduce call
+        long_input = ROLE_CONFIG.get(role, {}).get("long_input") if chat_model else None
+        map_long_input = None
+        if long_input and longinput.needs_map_reduce(user_input):
+            map_long_input = lambda text: run_map_phase(chat_model, system_prompt, long_input, text, buffer)
+        produce = lambda: stream_response(conversation, msgs, history, user_input, buffer, cache_ids,
+                                          map_long_input, image_urls, user_images)
+    
+    if profiling.is_enabled():
+        produce = profiling.profile_stream("turn", produce, model=model_name, role=role)
+    start_worker(buffer, produce)
+    return buffer
+
+
+def stream_response(conversation, msgs, history: List[Dict[str, Any]], user_input: str, buffer: TurnBuffer,
+                    cache_ids: Optional[set] = None, map_long_input=None,
+                    image_urls: Optional[Dict[str, str]] = None, user_images: Optional[List[str]] = None):
+    """Build the prompt and stream text deltas (runs in the background worker)"""
+    turn = telemetry.start_turn(buffer.model, buffer.role)
+    buffer.turn = turn
+    try:
+        with turn.stage("history.build"):
+            long_input = ROLE_CONFIG.get(buffer.role, {}).get("long_input")
+            msgs.clear()
+            
+            # Add history messages (excluding current user message)
+            for i, msg in enumerate(history):
+                if i == 0:  # Skip initial greeting
+                    continue
+                
+                if msg["role"] == "user":
+                    content = msg["content"]
+                    if long_input and longinput.needs_map_reduce(content):
+                        # Earlier oversized inputs were already processed in parts
+                        content = longinput.history_placeholder(content)
+                    if msg.get("images"):
+                        content = with_images(content, msg["images"], image_urls or {})
+                    msgs.add_message(with_cache_point(HumanMessage, content, msg.get("id") in (cache_ids or ())))
+                elif msg["role"] == "assistant":
+                    clean_msg = re.sub(r'```thinking.*?```', '', msg["content"], flags=re.DOTALL)
+                    clean_msg = clean_msg.strip()
+                    if long_input and longinput.needs_map_reduce(clean_msg):
+                        # Answers streamed part by part (edited text) are as long as the input
+                        clean_msg = longinput.history_placeholder(clean_msg)
+                    if clean_msg:
+                        msgs.add_message(with_cache_point(AIMessage, clean_msg, msg.get("id") in (cache_ids or ())))
+        
+        with turn.stage("prompt.format"):
+            # Clean input
+            clean_input = re.sub(r'```thinking.*?```', '', user_input, flags=re.DOTALL)
+            formatted_input = [{"role": "user", "content": clean_input}]
+            if user_images:
+                formatted_input[0]["content"] = with_images(clean_input, user_images, image_urls or {})
         
-        if msg["role"] == "user":
-            msgs.add_user_message(msg["content"])
-        elif msg["role"] == "assistant":
-            clean_msg = re.sub(r'```thinking.*?```', '', msg["content"], flags=re.DOTALL)
-            clean_msg = clean_msg.strip()
-            if clean_msg:
-                msgs.add_ai_message(clean_msg)
-    
-    # Clean input
-    clean_input = re.sub(r'```thinking.*?```', '', user_input, flags=re.DOTALL)
-    formatted_input = [{"role": "user", "content": clean_input}]
-    
-    # Stream response
-    return st.write_stream(
-        conversation.stream(
+        if map_long_input:
+            with turn.stage("longinput.map"):
+                reduce_prompt = yield from map_long_input(clean_input)
+                if reduce_prompt is None:
+                    return
+                formatted_input = [{"role": "user", "content": reduce_prompt}]
+        
+        # Stream response
+        turn.request_sent()
+        yield from conversation.stream(
             {"query": formatted_input},
             config={"configurable": {"session_id": "streamlit_chat"}}
         )
-    )
+    except Exception as e:
+        turn.fail(e)
+        raise
+    finally:
+        turn.finish()
+
+
+def stream_translation(chat_model: ChatModel, system_prompt: str, user_input: str, buffer: TurnBuffer,
+                       languages: tuple):
+    """Translate with the translation memory, sending only unknown segments (runs in the background worker)"""
+    turn = telemetry.start_turn(buffer.model, buffer.role)
+    buffer.turn = turn
+    source_lang, target_lang = languages
+    
+    def translate_batch(segments: List[str]) -> List[Optional[str]]:
+        messages = [HumanMessage(content=build_batch_prompt(segments, source_lang, target_lang))]
+        if system_prompt.strip():
+            messages.insert(0, SystemMessage(content=system_prompt))
+        turn.request_sent()
+        with turn.stage("translation.batch", segments=len(segments)):
+            reply = chat_model.llm.invoke(ChatPromptValue(messages=messages))
+        turn.record_usage(reply.usage_metadata)
+        return parse_batch_response(longinput.message_text(reply), len(segments))
+    
+    try:
+        clean_input = re.sub(r'```thinking.*?```', '', user_input, flags=re.DOTALL)
+        with turn.stage("translation.memory"):
+            text, stats = TRANSLATION_MEMORY.translate(clean_input, source_lang, target_lang, translate_batch,
+                                                       chat_model.base_kwargs["max_tokens"])
+        turn.root.attributes.update({f"translation_memory.{k}": v for k, v in stats.items()})
+        buffer.caption = format_stats(stats)
+        yield text
+    except Exception as e:
+        turn.fail(e)
+        raise
+    finally:
+        turn.finish()
+
+
+def run_map_phase(chat_model: ChatModel, system_prompt: str, config: Dict[str, Any], text: str,
+                  buffer: TurnBuffer):
+    """Process every part of an oversized input in parallel and return the reduce prompt
+    (None if the turn was cancelled).
+
+    A generator: for roles with "stream_parts" it yields each rewritten part in order
+    as soon as it is ready, and the reduce prompt gets only the notes.
+    """
+    stream_parts = config.get("stream_parts", False)
+    chunk_tokens = longinput.LONG_INPUT_CHUNK_TOKENS
+    if stream_parts:
+        # A rewritten part is about as long as its input and must fit in one reply with its notes
+        chunk_tokens = min(chunk_tokens, chat_model.base_kwargs["max_tokens"] // 2)
+    chunks = longinput.split_text(text, chunk_tokens)
+    total = len(chunks)
+    done = 0
+    buffer.set_progress(0, total)
+    
+    def process(index: int, chunk: str) -> str:
+        messages = [HumanMessage(content=longinput.build_map_prompt(config, text, index, total, chunk))]
+        if system_prompt.strip():
+            messages.insert(0, SystemMessage(content=system_prompt))
+        reply = chat_model.llm.invoke(ChatPromptValue(messages=messages))
+        if buffer.turn:
+            buffer.turn.record_usage(reply.usage_metadata)
+        return longinput.message_text(reply)
+    
+    def on_progress(index: int, ok: bool):
+        nonlocal done
+        done += 1
+        buffer.set_progress(done, total)
+    
+    def cancelled() -> bool:
+        return buffer.cancelled
+    
+    if not stream_parts:
+        results = longinput.map_chunks(chunks, process, on_progress, cancelled=cancelled)
+        if buffer.cancelled:
+            return None
+        return longinput.build_reduce_prompt(config, text, results)
+    
+    notes = []
+    for index, result in enumerate(longinput.iter_map_chunks(chunks, process, on_progress, cancelled=cancelled)):
+        part, part_notes = longinput.split_notes(result)
+        yield ("\n\n" if index else "") + part
+        notes.append(part_notes or "(no notes)")
+    if buffer.cancelled:
+        return None
+    yield "\n\n---\n\n"
+    return longinput.build_reduce_prompt(config, text, notes)
+
+
+def with_cache_point(message_class, content: Union[str, List[Dict[str, Any]]], cache: bool):
+    """Build a history message, optionally followed by a prompt cache checkpoint"""
+    if not cache:
+        return message_class(content=content)
+    blocks = content if isinstance(content, list) else [{"type": "text", "text": content}]
+    return message_class(content=[*blocks, CACHE_POINT])
+
+
+def with_images(text: str, image_ids: List[str], image_urls: Dict[str, str]) -> List[Dict[str, Any]]:
+    """User message content with its image attachments before the text"""
+    blocks = image_blocks(image_ids, image_urls)
+    if text.strip():
+        blocks.append({"type": "text", "text": text})
+    return blocks
+
+
+def display_active_response():
+    """Tail the session's background turn and store the answer once it is complete"""
+    buffer = st.session_state.get("active_turn")
+    if buffer is None:
+        return
+    
+    with st.chat_message("assistant"):
+        response = RenderCoalescer().follow(buffer)
+        error = None
+        if buffer.error is not None:
+            error = f"⚠️ Response failed: {telemetry.error_code(buffer.error)}: {buffer.error}"
+            st.error(error)
+    
+    del st.session_state["active_turn"]
+    if buffer.turn:
+        saved = buffer.turn.root.attributes.get("max_tokens.saved", 0)
+        st.session_state["reserved_tokens_saved"] = st.session_state.get("reserved_tokens_saved", 0) + saved
+    # Store failures too, so the error survives the rerun and the turn can be regenerated
+    if response or error:
+        store_message("assistant", response, parent=buffer.parent_id, caption=buffer.caption, error=error)
+    # Rerun so the chat input is enabled again
+    st.rerun()
 
 
 def new_chat(role_name: str = None):
@@ -835,22 +1275,16 @@ def new_chat(role_name: str = None):
     if role_name is None:
         role_name = st.session_state.get("selected_role", "Default")
     
-    # Get role-specific greeting
-    greeting_msg = get_role_greeting(role_name)
-    
-    st.session_state["messages"] = [{
-        "role": "assistant",
-        "content": greeting_msg,
-        "llm_content": f"Hello! I'm your {role_name} AI assistant. How can I help you today?"
-    }]
+    # Fresh conversation tree with role-specific greeting
+    reset_conversation(role_name)
     
     if "msgs" in st.session_state:
         st.session_state.msgs.clear()
     
-    if "current_llm_text" in st.session_state:
-        del st.session_state["current_llm_text"]
-    if "current_display_text" in st.session_state:
-        del st.session_state["current_display_text"]
+    # Stop any answer still being generated for the old conversation
+    if "active_turn" in st.session_state:
+        st.session_state.active_turn.cancel()
+        del st.session_state["active_turn"]
 
 
 def export_chat():
@@ -874,7 +1308,9 @@ def export_chat():
 
 
 def display_chat_messages():
-    """Display chat messages with enhanced styling"""
+    """Display chat messages with enhanced styling and branch controls"""
+    tree = st.session_state.conversation_tree
+    generating = "active_turn" in st.session_state
     for i, message in enumerate(st.session_state.messages):
         with st.chat_message(message["role"]):
             # Add message metadata for non-initial messages
@@ -883,48 +1319,219 @@ def display_chat_messages():
                 role_icon = "👤" if message["role"] == "user" else "🤖"
                 st.caption(f"{role_icon} {message['role'].title()} • {timestamp}")
             
-            st.markdown(message["content"])
+            if message.get("images"):
+                display_images(message["images"])
+            
+            if st.session_state.get("editing_node") == message["id"]:
+                display_message_editor(tree, message)
+            else:
+                st.markdown(message["content"])
+                if message.get("error"):
+                    st.error(message["error"])
+                if message.get("caption"):
+                    st.caption(message["caption"])
+            
+            if i > 0:
+                display_branch_controls(tree, message, disabled=generating)
+
+
+def display_images(image_ids: List[str]):
+    """Show a message's attachments from the session image cache"""
+    cache = st.session_state.get("image_cache", {})
+    shown = [cache[image_id] for image_id in image_ids if image_id in cache]
+    if shown:
+        st.image([image.data for image in shown], caption=[image.name for image in shown], width=240)
+
+
+def attach_images(files: List[Any], model_name: str) -> List[str]:
+    """Downscale uploaded images for the model and keep the ones that fit the turn budget"""
+    cache = st.session_state.setdefault("image_cache", {})
+    model_config = MODELS[model_name]
+    limits = {
+        "max_edge": model_config.get("image_max_edge", DEFAULT_MAX_EDGE),
+        "max_pixels": model_config.get("image_max_pixels", DEFAULT_MAX_PIXELS),
+    }
+    image_ids = []
+    used = 0
+    for file in files:
+        try:
+            image = get_image(cache, file.getvalue(), file.name, **limits)
+        except Exception as e:
+            st.warning(f"⚠️ Could not read {file.name}: {e}")
+            continue
+        if used + image.payload_size > IMAGE_TURN_BUDGET or len(image_ids) >= IMAGE_MAX_COUNT:
+            st.warning(f"⚠️ {file.name} left out: attachments exceed {IMAGE_TURN_BUDGET // 1024:,} KB per message")
+            continue
+        used += image.payload_size
+        image_ids.append(image.sha256)
+    return image_ids
+
+
+def display_profiler_panel():
+    """Admin panel with the recent rerun and turn profiles (profiling mode only)"""
+    with st.sidebar.expander("🩺 Profiler", expanded=False):
+        profiles = list(reversed(profiling.PROFILES)) or profiling.load_profiles()
+        if not profiles:
+            st.caption("No profiles yet. Every rerun and chat turn is profiled from now on.")
+            return
+        labels = {
+            p["id"]: f"{p['kind']} • {time.strftime('%H:%M:%S', time.localtime(p['started']))} • "
+                     f"{p['duration_ms']:,.0f} ms"
+            for p in profiles
+        }
+        selected = st.selectbox("Profile", list(labels), format_func=labels.get, key="profiler_selected")
+        profile = next(p for p in profiles if p["id"] == selected)
+        st.caption(f"{profile['samples']:,} samples every {profile['interval_ms']:g} ms"
+                   + (f" • saved to {profile['path']}" if profile.get("path") else ""))
+        
+        st.markdown("**⏱️ Stages**")
+        st.dataframe([{"stage": k, "ms": v} for k, v in profile["stages"].items()], hide_index=True)
+        st.markdown("**🔥 Functions** (sampled wall time)")
+        st.dataframe(profile["functions"], hide_index=True)
+        st.markdown("**🧮 Allocations** (net, top sites)")
+        st.dataframe(profile["allocations"], hide_index=True)
+
+
+def display_branch_controls(tree: ConversationTree, message: Dict[str, Any], disabled: bool):
+    """Branch navigation plus edit (user) or regenerate (assistant) for one message"""
+    node_id = message["id"]
+    siblings = tree.siblings(node_id)
+    index = siblings.index(node_id)
+    cols = st.columns([1, 1, 1, 1, 8])
+    
+    if len(siblings) > 1:
+        if cols[0].button("◀", key=f"prev_{node_id}", disabled=disabled or index == 0, help="Previous version"):
+            tree.switch(siblings[index - 1])
+            st.session_state.messages = tree.path()
+            st.rerun()
+        cols[1].caption(f"{index + 1}/{len(siblings)}")
+        if cols[2].button("▶", key=f"next_{node_id}", disabled=disabled or index == len(siblings) - 1,
+                          help="Next version"):
+            tree.switch(siblings[index + 1])
+            st.session_state.messages = tree.path()
+            st.rerun()
+    
+    if message["role"] == "user":
+        if cols[3].button("✏️", key=f"edit_{node_id}", disabled=disabled, help="Edit and resend"):
+            st.session_state.editing_node = node_id
+            st.rerun()
+    elif cols[3].button("🔄", key=f"regen_{node_id}", disabled=disabled, help="Regenerate response"):
+        # Branch off the user message this answer replied to
+        parent_id = tree.parents[node_id]
+        tree.set_leaf(parent_id)
+        st.session_state.messages = tree.path()
+        st.session_state.pending_prompt = tree.nodes[parent_id]["content"]
+        st.rerun()
+
+
+def display_message_editor(tree: ConversationTree, message: Dict[str, Any]):
+    """Edit a user message; saving starts a new branch from that point"""
+    node_id = message["id"]
+    new_content = st.text_area(
+        "Edit message",
+        value=message["content"],
+        key=f"editor_{node_id}",
+        label_visibility="collapsed"
+    )
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("💾 Save & Send", key=f"save_{node_id}", type="primary", use_container_width=True):
+            del st.session_state["editing_node"]
+            store_message("user", new_content, parent=tree.parents[node_id], images=message.get("images"))
+            st.session_state.pending_prompt = new_content
+            st.rerun()
+    with col2:
+        if st.button("Cancel", key=f"cancel_{node_id}", use_container_width=True):
+            del st.session_state["editing_node"]
+            st.rerun()
 
 
 def main():
     """Main function"""
-    set_page_config()
+    # Profile the whole rerun when profiling is on (no-op otherwise)
+    profiling_enabled = profiling.is_enabled()
+    profile = profiling.start("rerun", profiling_enabled)
+    try:
+        run_app(profile, profiling_enabled)
+    finally:
+        profile.finish()
+
+
+def run_app(profile, profiling_enabled: bool = False):
+    """Render the app, timing each stage of the rerun"""
+    with profile.stage("set_page_config"):
+        set_page_config()
+        telemetry.start_metrics_server()
     
     # Generate unique widget key
     if "widget_key" not in st.session_state:
         st.session_state["widget_key"] = str(random.randint(1, 1000000))
     
     # Render sidebar
-    params = render_sidebar()
+    with profile.stage("render_sidebar"):
+        params = render_sidebar()
+        if profiling_enabled:
+            display_profiler_panel()
     
     # Initialize chat model
-    chat_model = ChatModel(
-        model_name=params["model_name"],
-        model_kwargs={
-            "temperature": params["temperature"],
-            "top_p": params["top_p"],
-            "top_k": params["top_k"],
-            "max_tokens": params["max_tokens"]
-        }
-    )
+    with profile.stage("ChatModel"):
+        chat_model = ChatModel(
+            model_name=params["model_name"],
+            model_kwargs={
+                "temperature": params["temperature"],
+                "top_p": params["top_p"],
+                "top_k": params["top_k"],
+                "max_tokens": params["max_tokens"]
+            },
+            tools=ROLE_CONFIG.get(params["role"], {}).get("tools"),
+            role=params["role"],
+            adaptive_max_tokens=params["adaptive_max_tokens"]
+        )
+    
+    # Make the selected target language explicit to the model
+    system_prompt = params["system_prompt"]
+    languages = None
+    if params["target_lang"]:
+        if params["use_translation_memory"]:
+            languages = (params["source_lang"], params["target_lang"])
+        system_prompt = f"{system_prompt}\n\nTarget language: {params['target_lang']}".strip()
     
     # Initialize conversation
-    conversation = init_conversation(params["system_prompt"], chat_model)
+    with profile.stage("init_conversation"):
+        conversation = init_conversation(system_prompt, chat_model)
     
     # Display chat messages
-    display_chat_messages()
-    
-    # Enhanced user input with placeholder
-    if prompt := st.chat_input("💬 Ask me anything... (Press Enter to send)"):
-        # Store and display user message
-        store_message("user", prompt)
-        with st.chat_message("user"):
-            st.markdown(prompt)
-        
-        # Generate and display assistant response
-        with st.chat_message("assistant"):
-            response = generate_response(conversation, prompt)
-            store_message("assistant", response)
+    with profile.stage("display_chat_messages"):
+        display_chat_messages()
+    
+    # Enhanced user input with placeholder (disabled while an answer is being generated)
+    with profile.stage("chat_input"):
+        generating = "active_turn" in st.session_state
+        if submission := st.chat_input("💬 Ask me anything... (Press Enter to send)", disabled=generating,
+                                       accept_file="multiple", file_type=IMAGE_TYPES):
+            if generating:
+                st.toast("⏳ Please wait for the current answer to finish")
+            else:
+                prompt = submission.text
+                image_ids = attach_images(submission.files, params["model_name"])
+                if not prompt.strip() and not image_ids:
+                    st.stop()
+                
+                # Store and display user message
+                store_message("user", prompt, images=image_ids)
+                with st.chat_message("user"):
+                    display_images(image_ids)
+                    st.markdown(prompt)
+                
+                # Generate the response in the background
+                generate_response(conversation, prompt, params["model_name"], chat_model, system_prompt, languages)
+        elif (pending := st.session_state.pop("pending_prompt", None)) and not generating:
+            # Edited or regenerated message: its user node is already the end of the branch
+            generate_response(conversation, pending, params["model_name"], chat_model, system_prompt, languages)
+    
+    # Display the answer in progress (resumes after every rerun)
+    with profile.stage("stream"):
+        display_active_response()
 
 
 if __name__ == "__main__":
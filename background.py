@@ -0,0 +1,103 @@
+# background.py
+# Background generation owned by a Streamlit session
+#
+# A chat turn runs in a worker thread that writes text deltas into a TurnBuffer
+# kept in st.session_state. The script only tails the buffer, so a rerun (widget
+# click, sidebar change, tab switch) interrupts the display but never the
+# generation, and the partial answer is picked up again on the next run.
+# Workers must not call Streamlit APIs; everything they need is passed in.
+
+import threading
+import time
+import uuid
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import telemetry
+
+ACTIVE_TURNS = telemetry.counter("chatbot_background_turns_total", "Background turns by final state", ("state",))
+
+
+class TurnBuffer:
+    """Per-session buffer of streamed deltas for one chat turn"""
+
+    def __init__(self, model: str, role: str):
+        self.id = uuid.uuid4().hex[:8]
+        self.model = model
+        self.role = role
+        self.started = time.time()
+        self.deltas: List[str] = []
+        # perf_counter() when each delta arrived, and (time, delta count) of each render
+        self.appended: List[float] = []
+        self.rendered: List[Tuple[float, int]] = []
+        self.text = ""
+        self.done = False
+        self.cancelled = False
+        self.error: Optional[BaseException] = None
+        self.turn: Optional[telemetry.Turn] = None
+        # Conversation node the answer belongs to
+        self.parent_id: Optional[str] = None
+        # (done, total) parts of a long-input map phase, shown until the answer starts
+        self.progress: Optional[Tuple[int, int]] = None
+        # Note shown under the stored answer (e.g. translation memory hit rate)
+        self.caption: Optional[str] = None
+        self._cond = threading.Condition()
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.started
+
+    def append(self, delta: str):
+        with self._cond:
+            self.deltas.append(delta)
+            self.appended.append(time.perf_counter())
+            self.text += delta
+            self._cond.notify_all()
+
+    def set_progress(self, done: int, total: int):
+        with self._cond:
+            self.progress = (done, total)
+            self._cond.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    def cancel(self):
+        """Stop consuming the stream; the worker exits at the next delta"""
+        self.cancelled = True
+
+    def wait(self, since: int, timeout: float) -> Tuple[str, int, bool]:
+        """Wait up to `timeout` for deltas beyond `since`; return (text, delta count, done)"""
+        with self._cond:
+            if len(self.deltas) == since and not self.done:
+                self._cond.wait(timeout)
+            return self.text, len(self.deltas), self.done
+
+
+def start_worker(buffer: TurnBuffer, produce: Callable[[], Iterable[str]]) -> threading.Thread:
+    """Run `produce()` in a daemon thread, writing every delta into `buffer`"""
+
+    def run():
+        error = None
+        stream = iter(produce())
+        try:
+            for delta in stream:
+                if buffer.cancelled:
+                    break
+                if delta:
+                    buffer.append(delta)
+        except Exception as e:
+            error = e
+        finally:
+            # Closing the generator runs its cleanup (tracing) in this thread
+            if hasattr(stream, "close"):
+                stream.close()
+            buffer.finish(error)
+            state = "cancelled" if buffer.cancelled else "failed" if error else "completed"
+            ACTIVE_TURNS.inc(state=state)
+
+    thread = threading.Thread(target=run, name=f"turn-{buffer.id}", daemon=True)
+    thread.start()
+    return thread
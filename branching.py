@@ -0,0 +1,74 @@
+# branching.py
+# Conversation tree for editing and regenerating earlier messages
+#
+# Every message is a node stored once; a branch is just the path from the root
+# to a leaf, so sibling branches share their common prefix structurally. The
+# message dicts on the active path are the same objects as in the tree, never
+# copies, and switching branches only moves the leaf pointer.
+
+import uuid
+from typing import Any, Dict, List, Optional
+
+
+class ConversationTree:
+    """Tree of chat messages with one selected branch"""
+
+    def __init__(self, root_message: Dict[str, Any]):
+        self.nodes: Dict[str, Dict[str, Any]] = {}
+        self.parents: Dict[str, Optional[str]] = {}
+        self.children: Dict[Optional[str], List[str]] = {}
+        # Selected child at every fork, so returning to a branch restores its tail
+        self.selected: Dict[str, str] = {}
+        self.root = self._add(root_message, None)
+        self.leaf = self.root
+
+    def _add(self, message: Dict[str, Any], parent: Optional[str]) -> str:
+        node_id = uuid.uuid4().hex[:12]
+        message["id"] = node_id
+        self.nodes[node_id] = message
+        self.parents[node_id] = parent
+        self.children.setdefault(parent, []).append(node_id)
+        return node_id
+
+    def append(self, message: Dict[str, Any], parent: Optional[str] = None) -> str:
+        """Add `message` under `parent` (default: the current leaf) and make it the leaf"""
+        node_id = self._add(message, parent or self.leaf)
+        self.set_leaf(node_id)
+        return node_id
+
+    def path(self, leaf: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Messages from the root to `leaf` (default: the current leaf)"""
+        node_id = leaf or self.leaf
+        path = []
+        while node_id is not None:
+            path.append(self.nodes[node_id])
+            node_id = self.parents[node_id]
+        path.reverse()
+        return path
+
+    def siblings(self, node_id: str) -> List[str]:
+        return self.children.get(self.parents[node_id], [node_id])
+
+    def set_leaf(self, node_id: str):
+        """Make `node_id` the end of the active branch, selecting it at every fork above"""
+        child = node_id
+        parent = self.parents[child]
+        while parent is not None:
+            self.selected[parent] = child
+            child, parent = parent, self.parents[parent]
+        self.leaf = node_id
+
+    def switch(self, node_id: str):
+        """Show the branch through `node_id`, continuing down its last selected children"""
+        leaf = node_id
+        while self.children.get(leaf):
+            leaf = self.selected.get(leaf, self.children[leaf][-1])
+        self.set_leaf(leaf)
+
+    def last_fork(self, leaf: Optional[str] = None) -> Optional[str]:
+        """Deepest node on the branch that has several children, i.e. the end of the shared prefix"""
+        fork = None
+        for message in self.path(leaf)[:-1]:
+            if len(self.children.get(message["id"], [])) > 1:
+                fork = message["id"]
+        return fork
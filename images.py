@@ -0,0 +1,141 @@
+# images.py
+# Image attachments: local downscaling, session cache and payload budgeting
+#
+# Claude downsizes images larger than about 1568 px on the long edge (or about
+# 1.15 megapixels) before the model sees them, so uploading more resolution
+# only costs upload time. Images are resized to the model's effective
+# resolution and recompressed once, cached in the session by content hash,
+# and re-sent from the cache on later turns. A per-turn budget caps the image
+# bytes sent: the newest images are kept and older ones are left out.
+
+import base64
+import hashlib
+import io
+import math
+import os
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Dict, Iterable, List, Tuple
+
+from PIL import Image, ImageOps
+
+import telemetry
+
+IMAGE_TYPES = ["png", "jpg", "jpeg", "gif", "webp"]
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_TURN_BUDGET = int(os.environ.get("IMAGE_TURN_BUDGET_KB", "5000")) * 1024
+# Bedrock rejects larger images and more images per request
+IMAGE_MAX_BYTES = int(3.75 * 1024 * 1024)
+IMAGE_MAX_COUNT = 20
+
+# Defaults when a model does not declare its effective resolution
+DEFAULT_MAX_EDGE = 1568
+DEFAULT_MAX_PIXELS = 1_150_000
+# Smallest long edge an image is shrunk to while fitting the budget
+MIN_EDGE = 256
+
+IMAGE_BYTES = telemetry.counter("chatbot_image_bytes_total", "Image bytes uploaded and sent", ("stage",))
+IMAGES_OMITTED = telemetry.counter("chatbot_images_omitted_total", "History images left out to fit the turn budget")
+
+_MEDIA_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "GIF": "image/gif", "WEBP": "image/webp"}
+
+
+@dataclass
+class ProcessedImage:
+    """An attachment resized and encoded for the model"""
+    sha256: str
+    name: str
+    media_type: str
+    data: bytes
+    width: int
+    height: int
+    original_size: int
+
+    @cached_property
+    def data_url(self) -> str:
+        return f"data:{self.media_type};base64,{base64.b64encode(self.data).decode('ascii')}"
+
+    @property
+    def payload_size(self) -> int:
+        return len(self.data_url)
+
+
+def _encode(image: Image.Image) -> Tuple[bytes, str]:
+    """PNG for images with transparency, JPEG otherwise"""
+    buffer = io.BytesIO()
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image.save(buffer, format="PNG", optimize=True)
+        return buffer.getvalue(), "image/png"
+    image.convert("RGB").save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue(), "image/jpeg"
+
+
+def process_image(raw: bytes, name: str = "image", max_edge: int = DEFAULT_MAX_EDGE,
+                  max_pixels: int = DEFAULT_MAX_PIXELS, max_bytes: int = IMAGE_MAX_BYTES) -> ProcessedImage:
+    """Downscale to the model's effective resolution and recompress, keeping the original if it is smaller"""
+    digest = hashlib.sha256(raw).hexdigest()
+    with Image.open(io.BytesIO(raw)) as source:
+        source_format = source.format
+        image = ImageOps.exif_transpose(source)
+        image.load()
+    width, height = image.size
+    scale = min(1.0, max_edge / max(width, height), math.sqrt(max_pixels / (width * height)))
+
+    while True:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        resized = image.resize(size, Image.LANCZOS) if size != image.size else image
+        data, media_type = _encode(resized)
+        if scale == 1.0 and source_format in _MEDIA_TYPES and len(raw) <= len(data):
+            # Already small enough and well compressed: send the upload as-is
+            data, media_type = raw, _MEDIA_TYPES[source_format]
+        if len(data) <= max_bytes or max(size) <= MIN_EDGE:
+            break
+        scale *= 0.75
+
+    IMAGE_BYTES.inc(len(raw), stage="uploaded")
+    return ProcessedImage(digest, name, media_type, data, size[0], size[1], len(raw))
+
+
+def get_image(cache: Dict[str, ProcessedImage], raw: bytes, name: str = "image", **limits) -> ProcessedImage:
+    """Processed image for `raw`, encoding it only the first time it is seen in the session"""
+    digest = hashlib.sha256(raw).hexdigest()
+    if digest not in cache:
+        cache[digest] = process_image(raw, name, **limits)
+    return cache[digest]
+
+
+def fit_turn_budget(cache: Dict[str, ProcessedImage], current_ids: Iterable[str], history_ids: Iterable[str],
+                    budget: int = IMAGE_TURN_BUDGET) -> Dict[str, str]:
+    """Data URLs of the images to send this turn.
+
+    The current message's images are always sent. History images (in conversation
+    order) are added newest first while they fit in `budget`; the rest are left out.
+    """
+    included: Dict[str, str] = {}
+    used = 0
+    for image_id in current_ids:
+        if image_id in cache and image_id not in included:
+            included[image_id] = cache[image_id].data_url
+            used += cache[image_id].payload_size
+    for image_id in reversed(list(history_ids)):
+        if image_id not in cache or image_id in included:
+            continue
+        image = cache[image_id]
+        if used + image.payload_size > budget or len(included) >= IMAGE_MAX_COUNT:
+            IMAGES_OMITTED.inc()
+            continue
+        included[image_id] = image.data_url
+        used += image.payload_size
+    IMAGE_BYTES.inc(used, stage="sent")
+    return included
+
+
+def image_blocks(image_ids: Iterable[str], data_urls: Dict[str, str]) -> List[Dict]:
+    """Converse image content blocks, with a note for images left out of this turn"""
+    blocks = []
+    for image_id in image_ids:
+        if image_id in data_urls:
+            blocks.append({"type": "image_url", "image_url": {"url": data_urls[image_id]}})
+        else:
+            blocks.append({"type": "text", "text": "[An earlier image was attached here but is not included again]"})
+    return blocks
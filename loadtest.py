@@ -0,0 +1,465 @@
+# loadtest.py
+# Concurrent-session load test for Bedrock ChatBot
+#
+# Starts app.py under a real `streamlit run` server, patched to talk to a local
+# fake Bedrock backend that streams chunks on a realistic schedule, and drives N
+# simulated sessions over Streamlit's websocket protocol. Every session is a real
+# server session, so they contend for the one server process exactly as browser
+# tabs do. No AWS credentials are needed.
+#
+# Each fake chunk carries the wall-clock time it became available, so delivery is
+# measured where the user sees it: when the client received the render that first
+# showed the chunk. CPU and memory are sampled from the server process while the
+# level runs.
+#
+# Usage:
+#   python loadtest.py --sessions 1,2,4,8,16 --turns 2
+#   python loadtest.py --sessions 8 --ttft 0.8 --chunks 400 --chunk-interval 0.015
+
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.request
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# Every prompt carries a session/turn marker so identical prompts are not coalesced
+MARKER = "[loadtest session={session} turn={turn}]"
+
+# Chunk text; the timestamp is the wall-clock time the chunk became available
+CHUNK = "lorem@{available:.6f} "
+CHUNK_PATTERN = re.compile(r"lorem@(\d+\.\d+)")
+
+# Server-side settings, passed from the load generator through the environment
+FAKE_ENV = "LOADTEST_FAKE_BACKEND"
+ERRORS_ENV = "LOADTEST_ERRORS_FILE"
+
+_served = False
+
+
+class FakeBedrockConverse(BaseChatModel):
+    """Stand-in for ChatBedrockConverse that streams on a fixed server-side schedule.
+
+    Chunk i becomes available at request_start + ttft + i * chunk_interval (with jitter).
+    """
+
+    model: str = "fake"
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    max_tokens: Optional[int] = None
+    region_name: Optional[str] = None
+    endpoint_url: Optional[str] = None
+    additional_model_request_fields: Optional[Dict[str, Any]] = None
+    ttft: float = 0.6
+    chunks: int = 200
+    chunk_interval: float = 0.02
+    chunk_jitter: float = 0.3
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-bedrock-converse"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = "".join(chunk.message.content[0]["text"] for chunk in self._stream(messages) if chunk.message.content)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        available = time.time() + self.ttft
+        for i in range(self.chunks):
+            now = time.time()
+            if now < available:
+                time.sleep(available - now)
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content=[{"type": "text", "text": CHUNK.format(available=available), "index": 0}]
+            ))
+            available += self.chunk_interval * random.uniform(1 - self.chunk_jitter, 1 + self.chunk_jitter)
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content=[],
+            response_metadata={"stopReason": "end_turn"},
+            usage_metadata={"input_tokens": 100, "output_tokens": self.chunks, "total_tokens": 100 + self.chunks},
+        ))
+
+
+def serve():
+    """Run app.py inside the Streamlit server, against the fake backend"""
+    global _served
+    if not _served:
+        import langchain_aws
+
+        fake = json.loads(os.environ.get(FAKE_ENV, "{}"))
+        langchain_aws.ChatBedrockConverse = lambda **kwargs: FakeBedrockConverse(**{**kwargs, **fake})
+
+        # Uncaught exceptions in worker threads never reach a client; count them here
+        errors_file = os.environ.get(ERRORS_ENV)
+        default_hook = threading.excepthook
+
+        def excepthook(args):
+            if errors_file:
+                with open(errors_file, "a") as f:
+                    f.write(json.dumps({
+                        "thread": args.thread.name if args.thread else None,
+                        "error": "".join(traceback.format_exception_only(args.exc_type, args.exc_value)).strip(),
+                    }) + "\n")
+            default_hook(args)
+
+        threading.excepthook = excepthook
+        _served = True
+
+    with open(APP_PATH) as f:
+        code = compile(f.read(), APP_PATH, "exec")
+    exec(code, {"__name__": "__main__", "__file__": APP_PATH})
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(fake: Dict[str, Any], errors_file: str, timeout: float) -> tuple:
+    """Start `streamlit run` on this file in serve mode; return (process, port)"""
+    port = _free_port()
+    env = {**os.environ, FAKE_ENV: json.dumps(fake), ERRORS_ENV: errors_file}
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "streamlit", "run", os.path.abspath(__file__),
+            "--server.headless", "true",
+            "--server.address", "127.0.0.1",
+            "--server.port", str(port),
+            "--server.fileWatcherType", "none",
+            "--browser.gatherUsageStats", "false",
+            "--", "--serve",
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Streamlit server exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1) as response:
+                if response.status == 200:
+                    return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Streamlit server did not become healthy")
+
+
+class ServerSampler:
+    """Samples CPU time and resident memory of the server process from /proc"""
+
+    def __init__(self, pid: int, interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="server-sampler", daemon=True)
+
+    def cpu_seconds(self) -> Optional[float]:
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            # utime and stime are fields 14 and 15 of /proc/<pid>/stat
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def rss_bytes(self) -> Optional[int]:
+        try:
+            with open(f"/proc/{self.pid}/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self.rss_bytes() or 0)
+
+    def __enter__(self):
+        self.rss_start = self.rss_bytes()
+        self.cpu_start = self.cpu_seconds()
+        self.peak_rss = self.rss_start or 0
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        cpu_end = self.cpu_seconds()
+        self.cpu = cpu_end - self.cpu_start if cpu_end is not None and self.cpu_start is not None else None
+        self.rss_growth = self.peak_rss - self.rss_start if self.rss_start is not None else None
+
+
+class Session:
+    """One browser-like client of the Streamlit server"""
+
+    def __init__(self, ws, timeout: float):
+        self.ws = ws
+        self.timeout = timeout
+        self.chat_input_id: Optional[str] = None
+        self.seen: set = set()
+        self.errors: List[str] = []
+
+    def run(self, widget_states=None) -> List[tuple]:
+        """Request a script run and read until the session is idle.
+
+        Returns (receive time, new chunk timestamps) for every message that showed new chunks.
+        """
+        back = BackMsg()
+        back.rerun_script.query_string = ""
+        back.rerun_script.page_script_hash = ""
+        if widget_states:
+            back.rerun_script.widget_states.widgets.extend(widget_states)
+        self.ws.send(back.SerializeToString())
+
+        renders = []
+        deadline = time.time() + self.timeout
+        while True:
+            data = self.ws.recv(timeout=max(0.0, deadline - time.time()))
+            received = time.time()
+            msg = ForwardMsg()
+            msg.ParseFromString(data)
+            kind = msg.WhichOneof("type")
+            if kind == "delta" and msg.delta.WhichOneof("type") == "new_element":
+                element = msg.delta.new_element
+                element_type = element.WhichOneof("type")
+                if element_type == "chat_input":
+                    self.chat_input_id = element.chat_input.id
+                elif element_type == "exception":
+                    self.errors.append(f"{element.exception.type}: {element.exception.message}")
+                elif element_type == "alert" and element.alert.format == element.alert.ERROR:
+                    self.errors.append(element.alert.body)
+                elif element_type == "markdown":
+                    stamps = {float(s) for s in CHUNK_PATTERN.findall(element.markdown.body)} - self.seen
+                    if stamps:
+                        self.seen |= stamps
+                        renders.append((received, sorted(stamps)))
+            elif kind == "script_finished" and msg.script_finished == ForwardMsg.FINISHED_SUCCESSFULLY:
+                return renders
+            elif kind == "script_finished" and msg.script_finished == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                raise RuntimeError("app.py failed to compile")
+
+    def submit(self, prompt: str) -> List[tuple]:
+        if self.chat_input_id is None:
+            raise RuntimeError("chat input not rendered")
+        state = WidgetState(id=self.chat_input_id)
+        state.chat_input_value.data = prompt
+        return self.run([state])
+
+
+def _run_session(port: int, session: int, turns: int, timeout: float, results: List[Dict[str, Any]]):
+    from websockets.sync.client import connect
+
+    result = {"session": session, "turns": [], "error": None}
+    try:
+        with connect(f"ws://127.0.0.1:{port}/_stcore/stream", subprotocols=["streamlit"],
+                     open_timeout=timeout, max_size=None) as ws:
+            client = Session(ws, timeout)
+            client.run()
+            for turn in range(turns):
+                prompt = f"{MARKER.format(session=session, turn=turn)} Summarize our campaign performance."
+                submitted = time.time()
+                renders = client.submit(prompt)
+                result["turns"].append({
+                    "turn": turn, "submitted": submitted, "finished": time.time(), "renders": renders,
+                })
+        if client.errors:
+            result["error"] = client.errors[0]
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    results.append(result)
+
+
+def _summarize_turn(turn: Dict[str, Any]) -> Dict[str, Any]:
+    """TTFT, render gaps and the wait of the oldest new chunk in each render of one turn"""
+    renders = turn["renders"]
+    receives = [received for received, _ in renders]
+    return {
+        "ttft": receives[0] - turn["submitted"],
+        "gaps": [b - a for a, b in zip(receives, receives[1:])],
+        "lags": [max(0.0, received - stamps[0]) for received, stamps in renders],
+        "chunks": sum(len(stamps) for _, stamps in renders),
+    }
+
+
+def _server_errors(errors_file: str) -> int:
+    try:
+        with open(errors_file) as f:
+            return sum(1 for line in f if line.strip())
+    except OSError:
+        return 0
+
+
+def run_level(port: int, pid: int, errors_file: str, sessions: int, turns: int, timeout: float) -> Dict[str, Any]:
+    """Run one load level with `sessions` concurrent sessions and summarize it"""
+    results: List[Dict[str, Any]] = []
+    threads = [
+        threading.Thread(target=_run_session, args=(port, i, turns, timeout, results), name=f"session-{i}")
+        for i in range(sessions)
+    ]
+    server_errors_before = _server_errors(errors_file)
+    with ServerSampler(pid) as sampler:
+        wall_before = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.time() - wall_before
+    server_errors = _server_errors(errors_file) - server_errors_before
+
+    # Throughput is measured over the chat turns only, not the initial page loads
+    turn_times = [turn for result in results for turn in result["turns"]]
+    chat_window = (
+        max(t["finished"] for t in turn_times) - min(t["submitted"] for t in turn_times)
+        if turn_times else 0.0
+    )
+
+    per_session = []
+    total_chunks = 0
+    for result in sorted(results, key=lambda r: r["session"]):
+        ttfts, jitters, lags = [], [], []
+        for turn in result["turns"]:
+            if not turn["renders"]:
+                continue
+            timings = _summarize_turn(turn)
+            total_chunks += timings["chunks"]
+            ttfts.append(timings["ttft"])
+            if len(timings["gaps"]) > 1:
+                jitters.append(statistics.pstdev(timings["gaps"]))
+            lags.extend(timings["lags"])
+        per_session.append({
+            "session": result["session"],
+            "error": result["error"],
+            "ttft_s": statistics.mean(ttfts) if ttfts else None,
+            "jitter_ms": statistics.mean(jitters) * 1000 if jitters else None,
+            "max_lag_ms": max(lags) * 1000 if lags else None,
+        })
+
+    ok = [s for s in per_session if s["ttft_s"] is not None]
+    jitters = [s["jitter_ms"] for s in ok if s["jitter_ms"] is not None]
+    lags = [s["max_lag_ms"] for s in ok if s["max_lag_ms"] is not None]
+    return {
+        "sessions": sessions,
+        "errors": sum(1 for s in per_session if s["error"]) + server_errors,
+        "server_thread_errors": server_errors,
+        "wall_s": wall,
+        "throughput_chunks_s": total_chunks / chat_window if chat_window else 0.0,
+        "server_cpu_pct": sampler.cpu / wall * 100 if sampler.cpu is not None and wall else None,
+        "cpu_s_per_session": sampler.cpu / sessions if sampler.cpu is not None else None,
+        "peak_rss_mb_per_session": sampler.rss_growth / sessions / 2**20 if sampler.rss_growth is not None else None,
+        "ttft_p50_s": statistics.median(s["ttft_s"] for s in ok) if ok else None,
+        "ttft_max_s": max(s["ttft_s"] for s in ok) if ok else None,
+        "jitter_p50_ms": statistics.median(jitters) if jitters else None,
+        "max_lag_ms": max(lags) if lags else None,
+        "per_session": per_session,
+    }
+
+
+def find_saturation(levels: List[Dict[str, Any]], efficiency: float) -> Optional[int]:
+    """Return the first session count whose throughput scales below `efficiency` of linear"""
+    base = levels[0]
+    if not base["throughput_chunks_s"]:
+        return None
+    per_session_base = base["throughput_chunks_s"] / base["sessions"]
+    for level in levels[1:]:
+        if level["throughput_chunks_s"] < efficiency * per_session_base * level["sessions"]:
+            return level["sessions"]
+    return None
+
+
+def _fmt(value, spec: str, unit: str = "") -> str:
+    return format("-", f">{int(spec.split('.')[0]) + len(unit)}") if value is None else format(value, spec) + unit
+
+
+def print_report(levels: List[Dict[str, Any]], saturation: Optional[int], efficiency: float):
+    print(f"{'sessions':>8} {'errors':>6} {'chunks/s':>9} {'ttft p50':>9} {'ttft max':>9} "
+          f"{'jitter':>8} {'max lag':>9} {'srv cpu':>8} {'cpu/sess':>9} {'rss/sess':>9}")
+    for level in levels:
+        print(f"{level['sessions']:>8} {level['errors']:>6} {_fmt(level['throughput_chunks_s'], '9.1f')} "
+              f"{_fmt(level['ttft_p50_s'], '8.2f', 's')} {_fmt(level['ttft_max_s'], '8.2f', 's')} "
+              f"{_fmt(level['jitter_p50_ms'], '6.1f', 'ms')} {_fmt(level['max_lag_ms'], '7.0f', 'ms')} "
+              f"{_fmt(level['server_cpu_pct'], '7.0f', '%')} "
+              f"{_fmt(level['cpu_s_per_session'], '8.2f', 's')} {_fmt(level['peak_rss_mb_per_session'], '7.1f', 'MB')}")
+    for level in levels:
+        for session in level["per_session"]:
+            if session["error"]:
+                print(f"  {level['sessions']} sessions, session {session['session']}: {session['error'].splitlines()[0]}")
+        if level["server_thread_errors"]:
+            print(f"  {level['sessions']} sessions: {level['server_thread_errors']} uncaught server thread exception(s)")
+    if saturation is None:
+        print(f"\nThroughput scaled at >= {efficiency:.0%} of linear across all levels.")
+    else:
+        print(f"\nThroughput stops scaling at {saturation} sessions (< {efficiency:.0%} of linear).")
+
+
+def main():
+    if sys.argv[1:] == ["--serve"]:
+        # Script run inside the Streamlit server; import this file once so the fake backend is not redefined per run
+        import loadtest
+        loadtest.serve()
+        return
+
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for app.py")
+    parser.add_argument("--sessions", default="1,2,4,8", help="Comma-separated session counts to run")
+    parser.add_argument("--turns", type=int, default=2, help="Chat turns per session")
+    parser.add_argument("--ttft", type=float, default=0.6, help="Fake backend time to first token (s)")
+    parser.add_argument("--chunks", type=int, default=200, help="Chunks per response")
+    parser.add_argument("--chunk-interval", type=float, default=0.02, help="Mean seconds between chunks")
+    parser.add_argument("--chunk-jitter", type=float, default=0.3, help="Relative jitter of chunk interval")
+    parser.add_argument("--timeout", type=float, default=300, help="Per script-run timeout (s)")
+    parser.add_argument("--efficiency", type=float, default=0.8,
+                        help="Scaling efficiency below which throughput counts as saturated")
+    parser.add_argument("--json", help="Write the full report to this file")
+    args = parser.parse_args()
+
+    fake = {
+        "ttft": args.ttft,
+        "chunks": args.chunks,
+        "chunk_interval": args.chunk_interval,
+        "chunk_jitter": args.chunk_jitter,
+    }
+
+    fd, errors_file = tempfile.mkstemp(prefix="loadtest-errors-", suffix=".jsonl")
+    os.close(fd)
+    server, port = start_server(fake, errors_file, args.timeout)
+    levels = []
+    try:
+        # Warm up imports and caches so the first level is not charged for them
+        run_level(port, server.pid, errors_file, 1, 1, args.timeout)
+        for sessions in [int(n) for n in args.sessions.split(",") if n.strip()]:
+            print(f"Running {sessions} concurrent session(s)...", file=sys.stderr)
+            levels.append(run_level(port, server.pid, errors_file, sessions, args.turns, args.timeout))
+    finally:
+        server.terminate()
+        server.wait()
+        os.remove(errors_file)
+
+    saturation = find_saturation(levels, args.efficiency)
+    print_report(levels, saturation, args.efficiency)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"levels": levels, "saturation_sessions": saturation, "fake_backend": fake}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# longinput.py
+# Map-reduce processing for oversized user inputs
+#
+# Inputs above LONG_INPUT_TOKENS are split on natural boundaries (paragraphs,
+# lines, sentences) into chunks of about LONG_INPUT_CHUNK_TOKENS. The chunks are
+# processed concurrently with at most LONG_INPUT_WORKERS requests in flight, and
+# a final reduce prompt combines the partial results into one streamed answer.
+# Roles that rewrite the input (editing) stream each rewritten part in order as
+# soon as it is ready, and reduce only the notes that follow NOTES_MARKER, so no
+# single request has to hold or re-emit the whole text.
+
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+import telemetry
+
+LONG_INPUT_TOKENS = int(os.environ.get("LONG_INPUT_TOKENS", "12000"))
+LONG_INPUT_CHUNK_TOKENS = int(os.environ.get("LONG_INPUT_CHUNK_TOKENS", "6000"))
+LONG_INPUT_WORKERS = int(os.environ.get("LONG_INPUT_WORKERS", "4"))
+
+# Characters of the input shown with every chunk, so instructions at the top are not lost
+REQUEST_HEAD_CHARS = 1000
+# Line separating a rewritten part from its notes in map outputs of streamed roles
+NOTES_MARKER = "===NOTES==="
+
+LONG_INPUT_CHUNKS = telemetry.counter("chatbot_long_input_chunks_total", "Long-input chunks processed", ("outcome",))
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token for English text)"""
+    return len(text) // 4 + 1
+
+
+def needs_map_reduce(text: str, threshold: int = LONG_INPUT_TOKENS) -> bool:
+    return estimate_tokens(text) > threshold
+
+
+def split_text(text: str, chunk_tokens: int = LONG_INPUT_CHUNK_TOKENS) -> List[str]:
+    """Split on paragraph, line, sentence and word boundaries into chunks of about `chunk_tokens`"""
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_tokens,
+        chunk_overlap=0,
+        length_function=estimate_tokens,
+        separators=["\n\n", "\n", ". ", " ", ""],
+        keep_separator="end",
+    )
+    return splitter.split_text(text)
+
+
+def iter_map_chunks(chunks: List[str], process: Callable[[int, str], str],
+                    on_progress: Optional[Callable[[int, bool], None]] = None,
+                    workers: int = LONG_INPUT_WORKERS,
+                    cancelled: Optional[Callable[[], bool]] = None) -> Iterator[str]:
+    """Run `process(index, chunk)` for every chunk with bounded parallelism, yielding results
+    in input order as soon as all earlier chunks are done.
+
+    Chunks not yet started are dropped when `cancelled()` turns true or the caller
+    closes the generator; calls already running are left to finish in the background.
+    """
+    results: List[Optional[str]] = [None] * len(chunks)
+    emitted = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="long-input")
+    try:
+        # Each call runs under a copy of the caller's context so its spans attach to the current turn
+        futures = {
+            executor.submit(contextvars.copy_context().run, process, i, chunk): i for i, chunk in enumerate(chunks)
+        }
+        for future in as_completed(futures):
+            if cancelled and cancelled():
+                return
+            i = futures[future]
+            try:
+                results[i] = future.result()
+                ok = True
+            except Exception as e:
+                results[i] = f"[Part {i + 1} could not be processed: {telemetry.error_code(e)}]"
+                ok = False
+            LONG_INPUT_CHUNKS.inc(outcome="ok" if ok else "error")
+            if on_progress:
+                on_progress(i, ok)
+            while emitted < len(results) and results[emitted] is not None:
+                yield results[emitted]
+                emitted += 1
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def map_chunks(chunks: List[str], process: Callable[[int, str], str],
+               on_progress: Optional[Callable[[int, bool], None]] = None,
+               workers: int = LONG_INPUT_WORKERS,
+               cancelled: Optional[Callable[[], bool]] = None) -> List[str]:
+    """Run `process(index, chunk)` for every chunk with bounded parallelism, keeping input order
+    (only the leading results that finished before a cancellation)"""
+    return list(iter_map_chunks(chunks, process, on_progress, workers, cancelled))
+
+
+def build_map_prompt(config: Dict[str, Any], text: str, index: int, total: int, chunk: str) -> str:
+    return config["map"].format(index=index + 1, total=total, request=text[:REQUEST_HEAD_CHARS], part=chunk)
+
+
+def split_notes(result: str) -> Tuple[str, str]:
+    """Split a map output into the rewritten part and its notes (empty if the marker is missing)"""
+    part, _, notes = result.partition(NOTES_MARKER)
+    return part.strip(), notes.strip()
+
+
+def build_reduce_prompt(config: Dict[str, Any], text: str, results: List[str]) -> str:
+    parts = "\n\n".join(f"### Part {i + 1} of {len(results)}\n{result}" for i, result in enumerate(results))
+    return config["reduce"].format(total=len(results), request=text[:REQUEST_HEAD_CHARS], results=parts)
+
+
+def history_placeholder(text: str) -> str:
+    """Short stand-in for an oversized input in later turns' history"""
+    return (f"{text[:REQUEST_HEAD_CHARS]}\n\n[... long input of about {estimate_tokens(text):,} tokens, "
+            f"processed in parts; only the beginning is kept in the conversation history]")
+
+
+def message_text(message: Any) -> str:
+    """Plain text of a model reply (string content or Converse content blocks)"""
+    content = message.content
+    if isinstance(content, str):
+        return content
+    return "".join(item.get("text", "") for item in content if isinstance(item, dict) and item.get("type") == "text")
@@ -7,7 +7,11 @@ MODELS = {
         "temperature": 1.0,
         "top_p": 1.0,
         "top_k": 500,
+        "regions": ["us-east-1", "us-east-2", "us-west-2"],
         "max_tokens": 32000,
+        "prompt_cache": False,
+        "image_max_edge": 1568,
+        "image_max_pixels": 1150000,
         "default_prompt": "You are a helpful, thoughtful, and knowledgeable assistant. Your job is to carefully analyze the user's questions, understand their underlying needs, and provide clear, accurate, and useful answers. You always ask clarifying questions if something is ambiguous, and you aim to make complex topics easy to understand. Your responses should be practical, well-structured, and tailored to the user's context whenever possible.\n\nStay professional but friendly, and ensure that your explanations are grounded in facts and logic. If a task requires multiple steps, break it down clearly. When appropriate, offer examples, comparisons, or step-by-step instructions to enhance clarity and usefulness."
     },
     "Claude 3.7 Sonnet": {
@@ -15,7 +19,11 @@ MODELS = {
         "temperature": 1.0,
         "top_p": 1.0,
         "top_k": 500,
+        "regions": ["us-east-1", "us-east-2", "us-west-2"],
         "max_tokens": 64000,
+        "prompt_cache": True,
+        "image_max_edge": 1568,
+        "image_max_pixels": 1150000,
         "default_prompt": "You are a helpful, thoughtful, and knowledgeable assistant. Your job is to carefully analyze the user's questions, understand their underlying needs, and provide clear, accurate, and useful answers. You always ask clarifying questions if something is ambiguous, and you aim to make complex topics easy to understand. Your responses should be practical, well-structured, and tailored to the user's context whenever possible.\n\nStay professional but friendly, and ensure that your explanations are grounded in facts and logic. If a task requires multiple steps, break it down clearly. When appropriate, offer examples, comparisons, or step-by-step instructions to enhance clarity and usefulness."
     },
     "Claude 4 Sonnet": {
@@ -23,7 +31,11 @@ MODELS = {
         "temperature": 1.0,
         "top_p": 1.0,
         "top_k": 500,
+        "regions": ["us-east-1", "us-east-2", "us-west-2"],
         "max_tokens": 32000,
+        "prompt_cache": True,
+        "image_max_edge": 1568,
+        "image_max_pixels": 1150000,
         "default_prompt": "You are a helpful, thoughtful, and knowledgeable assistant. Your job is to carefully analyze the user's questions, understand their underlying needs, and provide clear, accurate, and useful answers. You always ask clarifying questions if something is ambiguous, and you aim to make complex topics easy to understand. Your responses should be practical, well-structured, and tailored to the user's context whenever possible.\n\nStay professional but friendly, and ensure that your explanations are grounded in facts and logic. If a task requires multiple steps, break it down clearly. When appropriate, offer examples, comparisons, or step-by-step instructions to enhance clarity and usefulness."
     }
 } 
\ No newline at end of file
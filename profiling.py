@@ -0,0 +1,271 @@
+# profiling.py
+# Built-in profiling of script reruns and chat turns
+#
+# Enabled for every session with PROFILE_ENABLED=1; with PROFILE_ENABLED=allow
+# the ?profile=1 query parameter turns it on per session (tracemalloc slows the
+# whole process, so browsers cannot switch it on unless the operator allows it).
+# Each rerun (and each background turn) is profiled by a sampling thread that
+# reads the profiled threads' stacks from sys._current_frames() every
+# PROFILE_INTERVAL_MS, plus named stage timings and a tracemalloc diff of the
+# top allocation sites. A turn's profile also samples the threads doing its work
+# (single-flight producer, tool pool) while they run attach_thread().
+# Profiles are kept in memory for the admin panel and written as JSON to
+# PROFILE_DIR for later comparison. With the flag off every entry point is a
+# no-op: no thread, no tracing, stages are a shared nullcontext.
+
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set
+
+import streamlit as st
+
+# "1" profiles every session, "allow" lets ?profile=1 enable it per session
+PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "0")
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL_MS", "5")) / 1000
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "./profiles")
+PROFILE_TOP_N = int(os.environ.get("PROFILE_TOP_N", "25"))
+# Frames tracemalloc records per allocation; 1 keeps its overhead moderate
+PROFILE_TRACE_FRAMES = 1
+
+# Recent profiles across all sessions, newest last
+PROFILES: Deque[Dict[str, Any]] = deque(maxlen=50)
+
+_NULL_STAGE = nullcontext()
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+# Profile of the turn running in this context, for threads that work on its behalf
+_current_profile: contextvars.ContextVar[Optional["Profile"]] = contextvars.ContextVar(
+    "current_profile", default=None
+)
+
+
+def is_enabled() -> bool:
+    """Profiling flag from the environment, or ?profile=1 when allowed (script thread only)"""
+    if PROFILE_ENABLED == "1":
+        return True
+    return PROFILE_ENABLED == "allow" and st.query_params.get("profile") == "1"
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACE_FRAMES)
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+
+class Profile:
+    """Sampling profile of one or more threads between start() and finish()"""
+
+    def __init__(self, kind: str, interval: float = PROFILE_INTERVAL, **attributes):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{kind}-{uuid.uuid4().hex[:6]}"
+        self.kind = kind
+        self.interval = interval
+        self.attributes = attributes
+        self.stages: Dict[str, float] = {}
+        self.samples = 0
+        self._self_counts: Counter = Counter()
+        self._total_counts: Counter = Counter()
+        self._thread_ids: Set[int] = {threading.get_ident()}
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.duration = 0.0
+        self.result: Optional[Dict[str, Any]] = None
+
+    def start(self) -> "Profile":
+        _start_tracemalloc()
+        self._snapshot = tracemalloc.take_snapshot()
+        self._sampler = threading.Thread(target=self._sample, name=f"profiler-{self.kind}", daemon=True)
+        self._sampler.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            self.samples += 1
+            for thread_id in list(self._thread_ids):
+                frame = frames.get(thread_id)
+                seen = set()
+                leaf = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_name, code.co_filename, code.co_firstlineno)
+                    if leaf:
+                        self._self_counts[key] += 1
+                        leaf = False
+                    if key not in seen:
+                        # Recursive functions count once per sample in the cumulative time
+                        self._total_counts[key] += 1
+                        seen.add(key)
+                    frame = frame.f_back
+
+    def stage(self, name: str):
+        return _timed_stage(self, name)
+
+    def finish(self) -> Dict[str, Any]:
+        """Stop sampling, build the report, keep it for the admin panel and save it to disk"""
+        if self.result is not None:
+            return self.result
+        self.duration = time.perf_counter() - self._start
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+        allocations = []
+        if self._snapshot is not None:
+            stats = tracemalloc.take_snapshot().compare_to(self._snapshot, "lineno")
+            _stop_tracemalloc()
+            for stat in stats[:PROFILE_TOP_N]:
+                frame = stat.traceback[0]
+                allocations.append({
+                    "location": f"{_short_path(frame.filename)}:{frame.lineno}",
+                    "size_kb": round(stat.size_diff / 1024, 1),
+                    "count": stat.count_diff,
+                })
+        self.result = {
+            "id": self.id,
+            "kind": self.kind,
+            "started": self.started,
+            "duration_ms": round(self.duration * 1000, 1),
+            "samples": self.samples,
+            "interval_ms": self.interval * 1000,
+            "attributes": self.attributes,
+            "stages": {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+            "functions": self._functions(),
+            "allocations": allocations,
+        }
+        PROFILES.append(self.result)
+        self.result["path"] = save_profile(self.result)
+        return self.result
+
+    def _functions(self) -> List[Dict[str, Any]]:
+        rows = []
+        for key, total in self._total_counts.most_common(PROFILE_TOP_N):
+            name, filename, line = key
+            rows.append({
+                "function": name,
+                "location": f"{_short_path(filename)}:{line}",
+                "total_ms": round(total * self.interval * 1000, 1),
+                "self_ms": round(self._self_counts.get(key, 0) * self.interval * 1000, 1),
+            })
+        return rows
+
+
+class _NullProfile:
+    """Stand-in used when profiling is off"""
+
+    def stage(self, name: str):
+        return _NULL_STAGE
+
+    def finish(self):
+        return None
+
+
+NULL_PROFILE = _NullProfile()
+
+
+@contextmanager
+def _timed_stage(profile: Profile, name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.stages[name] = profile.stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def start(kind: str, enabled: bool, **attributes):
+    """Profile the calling thread until finish(), or return the no-op profile"""
+    if not enabled:
+        return NULL_PROFILE
+    return Profile(kind, **attributes).start()
+
+
+def profile_stream(kind: str, produce: Callable[[], Iterable[Any]], **attributes) -> Callable[[], Iterator[Any]]:
+    """Wrap a background producer so its thread (and threads it attaches) is profiled while it streams"""
+
+    def run():
+        profile = Profile(kind, **attributes).start()
+        token = _current_profile.set(profile)
+        try:
+            with profile.stage("first_delta"):
+                stream = iter(produce())
+                first = next(stream, None)
+            if first is None:
+                return
+            with profile.stage("stream"):
+                yield first
+                yield from stream
+        finally:
+            _current_profile.reset(token)
+            profile.finish()
+
+    return run
+
+
+@contextmanager
+def attach_thread():
+    """Sample the calling thread in the current turn's profile, if any, until the block exits"""
+    profile = _current_profile.get()
+    thread_id = threading.get_ident()
+    if profile is None or thread_id in profile._thread_ids:
+        yield
+        return
+    profile._thread_ids.add(thread_id)
+    try:
+        yield
+    finally:
+        profile._thread_ids.discard(thread_id)
+
+
+def save_profile(result: Dict[str, Any]) -> Optional[str]:
+    if not PROFILE_DIR:
+        return None
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{result['id']}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        return path
+    except OSError:
+        return None
+
+
+def load_profiles(limit: int = 50) -> List[Dict[str, Any]]:
+    """Saved profiles from PROFILE_DIR, newest first"""
+    if not PROFILE_DIR or not os.path.isdir(PROFILE_DIR):
+        return []
+    names = sorted((n for n in os.listdir(PROFILE_DIR) if n.endswith(".json")), reverse=True)[:limit]
+    profiles = []
+    for name in names:
+        try:
+            with open(os.path.join(PROFILE_DIR, name), encoding="utf-8") as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+
+def _short_path(filename: str) -> str:
+    """Path relative to the app or site-packages, for readable tables"""
+    for marker in ("site-packages" + os.sep, os.getcwd() + os.sep):
+        if marker in filename:
+            return filename.split(marker, 1)[1]
+    return filename
@@ -0,0 +1,102 @@
+# rendering.py
+# Coalesced rendering of streamed markdown
+#
+# st.write_stream re-renders the whole accumulated answer on every delta. The
+# coalescer tails the turn's buffer and renders at most once per interval, and
+# closes any open code fence so every intermediate frame is valid markdown.
+
+import os
+import re
+import time
+from typing import Optional
+
+import streamlit as st
+
+import telemetry
+
+RENDER_INTERVAL = float(os.environ.get("RENDER_INTERVAL_MS", "50")) / 1000
+
+RENDER_UPDATES = telemetry.counter("chatbot_render_updates_total", "Markdown re-renders sent to the browser")
+RENDER_UPDATES_AVOIDED = telemetry.counter(
+    "chatbot_render_updates_avoided_total", "Stream deltas merged into a later render instead of re-rendering"
+)
+
+FENCE_PATTERN = re.compile(r"^ {0,3}(`{3,}|~{3,})", re.MULTILINE)
+
+
+def close_open_fences(text: str) -> str:
+    """Append a closing fence if `text` ends inside a fenced code block"""
+    open_fence: Optional[str] = None
+    for match in FENCE_PATTERN.finditer(text):
+        fence = match.group(1)
+        if open_fence is None:
+            open_fence = fence
+        elif fence[0] == open_fence[0] and len(fence) >= len(open_fence):
+            open_fence = None
+    if open_fence is None:
+        return text
+    return text + ("\n" if not text.endswith("\n") else "") + open_fence
+
+
+class RenderCoalescer:
+    """Render a stream of markdown deltas into one placeholder with batched updates"""
+
+    def __init__(self, interval: float = RENDER_INTERVAL):
+        self.interval = interval
+        self.deltas = 0
+        self.renders = 0
+
+    @property
+    def avoided(self) -> int:
+        return max(0, self.deltas - self.renders)
+
+    def follow(self, buffer, heartbeat: float = 0.5) -> str:
+        """Tail a background TurnBuffer until it is done and return the full text.
+
+        The buffer is polled once per interval, so deltas arriving in between are
+        merged into one render. A status caption is refreshed every `heartbeat` seconds, which
+        also gives Streamlit a point to interrupt the tail when a rerun is requested.
+        """
+        status = st.empty()
+        placeholder = st.empty()
+        rendered_count = 0
+        last_heartbeat = 0.0
+        start_ns = time.time_ns()
+        try:
+            while True:
+                text, count, done = buffer.wait(rendered_count, self.interval)
+                rendered = count != rendered_count
+                if rendered:
+                    self.deltas += count - rendered_count
+                    self._render(placeholder, text)
+                    # Render-side timing, for measuring stalls as the user sees them
+                    buffer.rendered.append((time.perf_counter(), count))
+                    rendered_count = count
+                if done:
+                    status.empty()
+                    break
+                now = time.monotonic()
+                if now - last_heartbeat >= heartbeat:
+                    if buffer.progress and (not rendered_count or buffer.progress[0] < buffer.progress[1]):
+                        parts_done, parts = buffer.progress
+                        status.progress(parts_done / parts, text=f"📄 Processing long input: {parts_done}/{parts} "
+                                                                  f"parts done... {buffer.elapsed:.0f}s")
+                    else:
+                        status.caption(f"⏳ Generating... {buffer.elapsed:.0f}s")
+                    last_heartbeat = now
+                if rendered:
+                    # Let deltas accumulate for one interval before the next render
+                    time.sleep(self.interval)
+        finally:
+            self._report()
+        if buffer.turn:
+            buffer.turn.record_span("render", start_ns, updates=self.renders, updates_avoided=self.avoided)
+        return buffer.text
+
+    def _render(self, placeholder, text: str):
+        placeholder.markdown(close_open_fences(text))
+        self.renders += 1
+
+    def _report(self):
+        RENDER_UPDATES.inc(self.renders)
+        RENDER_UPDATES_AVOIDED.inc(self.avoided)
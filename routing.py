@@ -0,0 +1,196 @@
+# routing.py
+# Health-based multi-region routing for Bedrock inference
+#
+# Each model has a pool of regions. The router keeps the time-to-first-token
+# and errors per (model, region) seen in the last ROUTING_WINDOW_SECONDS, sends
+# each new request to the healthiest, fastest region and fails over to the next
+# one when a region errors before the first token has been streamed. Samples
+# expire and a share of requests (ROUTING_PROBE_RATE) goes to another region,
+# so one slow or throttled request does not pin all traffic to a single region;
+# only the circuit breaker (repeated failures in a row) excludes a region.
+
+import os
+import random
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+import telemetry
+
+FAILOVERS = telemetry.counter(
+    "chatbot_region_failovers_total", "Requests moved to another region before the first token", ("model", "region")
+)
+REGION_REQUESTS = telemetry.counter(
+    "chatbot_region_requests_total", "Requests sent to each region", ("model", "region", "outcome")
+)
+
+ROUTING_WINDOW_SECONDS = float(os.environ.get("ROUTING_WINDOW_SECONDS", "120"))
+ROUTING_PROBE_RATE = float(os.environ.get("ROUTING_PROBE_RATE", "0.05"))
+
+# Errors that would fail the same way in every region, so failing over only adds latency
+NON_RETRYABLE_ERRORS = {"ValidationException", "ValueError", "TypeError"}
+
+
+def endpoint_url_for(region: Optional[str]) -> Optional[str]:
+    """Per-region endpoint override, e.g. BEDROCK_ENDPOINT_URL_US_WEST_2=http://localhost:9001"""
+    if region:
+        url = os.environ.get(f"BEDROCK_ENDPOINT_URL_{region.upper().replace('-', '_')}")
+        if url:
+            return url
+    return os.environ.get("AWS_BEDROCK_ENDPOINT_URL")
+
+
+def regions_from_env() -> Optional[List[str]]:
+    """Region pool override from BEDROCK_REGIONS (comma-separated)"""
+    value = os.environ.get("BEDROCK_REGIONS", "")
+    regions = [r.strip() for r in value.split(",") if r.strip()]
+    return regions or None
+
+
+class RegionHealth:
+    """TTFT and error statistics for one (model, region) over a sliding time window"""
+
+    def __init__(self, window: int = 50, failure_threshold: int = 3, cooldown: float = 30.0,
+                 window_seconds: float = ROUTING_WINDOW_SECONDS):
+        # (monotonic time, value) samples; at most `window`, none older than `window_seconds`
+        self.ttfts: Deque[Tuple[float, float]] = deque(maxlen=window)
+        self.outcomes: Deque[Tuple[float, bool]] = deque(maxlen=window)
+        self.window_seconds = window_seconds
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float):
+        cutoff = now - self.window_seconds
+        for samples in (self.ttfts, self.outcomes):
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+
+    def error_rate(self, now: float) -> float:
+        with self._lock:
+            self._expire(now)
+            if not self.outcomes:
+                return 0.0
+            return sum(1 for _, ok in self.outcomes if not ok) / len(self.outcomes)
+
+    def ttft(self, now: float) -> Optional[float]:
+        with self._lock:
+            self._expire(now)
+            return statistics.median(ttft for _, ttft in self.ttfts) if self.ttfts else None
+
+    def available(self, now: float) -> bool:
+        return now >= self.open_until
+
+    def record_success(self, ttft: float, now: float):
+        with self._lock:
+            self.ttfts.append((now, ttft))
+            self.outcomes.append((now, True))
+            self.consecutive_failures = 0
+
+    def record_failure(self, now: float):
+        with self._lock:
+            self.outcomes.append((now, False))
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                # Circuit breaker: skip this region until the cooldown has passed
+                self.open_until = now + self.cooldown
+
+
+class RegionRouter:
+    """Process-wide router shared by every session"""
+
+    def __init__(self, window: int = 50, failure_threshold: int = 3, cooldown: float = 30.0,
+                 error_penalty: float = 10.0, probe_rate: float = ROUTING_PROBE_RATE):
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.error_penalty = error_penalty
+        self.probe_rate = probe_rate
+        self._health: Dict[Tuple[str, str], RegionHealth] = {}
+        self._lock = threading.Lock()
+
+    def health(self, model_id: str, region: str) -> RegionHealth:
+        key = (model_id, region)
+        with self._lock:
+            if key not in self._health:
+                self._health[key] = RegionHealth(self.window, self.failure_threshold, self.cooldown)
+            return self._health[key]
+
+    def rank(self, model_id: str, regions: List[str]) -> List[str]:
+        """Order regions from healthiest/fastest to worst; open circuits go last.
+
+        With probability `probe_rate` another available region is tried first, so
+        regions that are not preferred keep being measured.
+        """
+        now = time.monotonic()
+
+        def score(item):
+            index, region = item
+            health = self.health(model_id, region)
+            # Regions without recent samples sort first so they get measured; ties keep pool order.
+            # Errors cost `error_penalty` seconds of TTFT at a 100% error rate.
+            ttft = health.ttft(now)
+            penalty = self.error_penalty * health.error_rate(now)
+            return (not health.available(now), (ttft or 0.0) + penalty, index)
+
+        ranked = [region for _, region in sorted(enumerate(regions), key=score)]
+        candidates = [r for r in ranked[1:] if self.health(model_id, r).available(now)]
+        if candidates and random.random() < self.probe_rate:
+            probe = random.choice(candidates)
+            ranked.remove(probe)
+            ranked.insert(0, probe)
+        return ranked
+
+    def stream(self, model_id: str, regions: List[str], get_llm: Callable[[str], Any],
+               prompt: Any, **kwargs) -> Iterator[Any]:
+        """Stream from the best region, failing over on errors before the first token"""
+        turn = telemetry.current_turn()
+        last_error: Optional[BaseException] = None
+        for attempt, region in enumerate(self.rank(model_id, regions)):
+            health = self.health(model_id, region)
+            if attempt:
+                FAILOVERS.inc(model=model_id, region=region)
+            start = time.monotonic()
+            stream = None
+            connected_ns = None
+            try:
+                stream = iter(get_llm(region).stream(prompt, **kwargs))
+                buffered = []
+                for chunk in stream:
+                    if connected_ns is None:
+                        connected_ns = time.time_ns()
+                    buffered.append(chunk)
+                    if getattr(chunk, "content", None):
+                        break
+            except Exception as e:
+                if stream is not None and hasattr(stream, "close"):
+                    stream.close()
+                health.record_failure(time.monotonic())
+                REGION_REQUESTS.inc(model=model_id, region=region, outcome=telemetry.error_code(e))
+                if telemetry.error_code(e) in NON_RETRYABLE_ERRORS:
+                    raise
+                last_error = e
+                continue
+
+            now = time.monotonic()
+            health.record_success(now - start, now)
+            REGION_REQUESTS.inc(model=model_id, region=region, outcome="ok")
+            if turn:
+                turn.root.attributes["cloud.region"] = region
+                turn.root.attributes["failover_attempts"] = attempt
+                turn.chunk_received(connected_ns)
+            # The first token has been streamed: errors from here on are surfaced as-is
+            yield from buffered
+            yield from stream
+            return
+
+        if last_error is not None:
+            raise last_error
+        raise RuntimeError(f"No regions configured for {model_id}")
+
+
+ROUTER = RegionRouter()
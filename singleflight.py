@@ -0,0 +1,200 @@
+# singleflight.py
+# Process-wide coalescing of identical in-flight generations
+#
+# Requests with the same fingerprint (model, parameters, tools and the full
+# prompt: system prompt, history and query) share one Bedrock stream. A request
+# that arrives while an identical one is streaming gets every chunk produced so
+# far, then live fan-out of the rest. Each subscriber has a bounded buffer; a
+# subscriber that falls behind stops receiving pushes and catches up from the
+# flight's chunk log instead, so a slow browser never stalls the producer. When
+# every subscriber has left (New Chat, cancelled turn), the producer closes the
+# Bedrock stream instead of paying for an answer nobody reads.
+
+import contextvars
+import hashlib
+import json
+import os
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import telemetry
+
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "1") != "0"
+SINGLE_FLIGHT_BUFFER = int(os.environ.get("SINGLE_FLIGHT_BUFFER", "256"))
+
+FLIGHTS = telemetry.counter("chatbot_single_flight_total", "Generations by single-flight role", ("role",))
+OVERFLOWS = telemetry.counter(
+    "chatbot_single_flight_overflows_total", "Subscribers that fell behind and switched to log catch-up"
+)
+ABANDONED = telemetry.counter(
+    "chatbot_single_flight_abandoned_total", "Generations stopped because every subscriber left"
+)
+
+_DONE = object()
+
+
+def fingerprint(*parts: Any) -> str:
+    """Stable hash of request parts (messages are reduced to type and content)"""
+    def normalize(value):
+        if hasattr(value, "type") and hasattr(value, "content"):
+            return [value.type, value.content]
+        return value
+
+    payload = json.dumps([normalize(p) for p in parts], default=normalize, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Subscriber:
+    def __init__(self, buffer_size: int):
+        self.queue: "queue.Queue[Any]" = queue.Queue(maxsize=buffer_size)
+        self.cursor = 0
+        self.overflowed = False
+
+
+class Flight:
+    """One in-flight generation and its subscribers"""
+
+    def __init__(self, key: str, buffer_size: int):
+        self.key = key
+        self.buffer_size = buffer_size
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers: List[_Subscriber] = []
+        self.lock = threading.Lock()
+
+    def _push(self, subscriber: _Subscriber, item: Any):
+        try:
+            subscriber.queue.put_nowait(item)
+        except queue.Full:
+            subscriber.overflowed = True
+            OVERFLOWS.inc()
+
+    def publish(self, chunk: Any):
+        with self.lock:
+            self.chunks.append(chunk)
+            for subscriber in self.subscribers:
+                if not subscriber.overflowed:
+                    self._push(subscriber, chunk)
+
+    def finish(self, error: Optional[BaseException] = None):
+        with self.lock:
+            self.done = True
+            self.error = error
+            for subscriber in self.subscribers:
+                if not subscriber.overflowed:
+                    self._push(subscriber, _DONE)
+
+    def subscribe(self) -> Iterator[Any]:
+        """Register a subscriber now and return its stream (closing the stream unsubscribes)"""
+        subscriber = _Subscriber(self.buffer_size)
+        with self.lock:
+            backlog = list(self.chunks)
+            finished = self.done
+            self.subscribers.append(subscriber)
+        return self._follow(subscriber, backlog, finished)
+
+    def _follow(self, subscriber: _Subscriber, backlog: List[Any], finished: bool) -> Iterator[Any]:
+        try:
+            yield from backlog
+            subscriber.cursor = len(backlog)
+            if finished:
+                yield from self._drain_finished(subscriber)
+                return
+            while True:
+                if subscriber.overflowed and subscriber.queue.empty():
+                    # Catch up from the log, then resume live pushes
+                    with self.lock:
+                        missing = self.chunks[subscriber.cursor:]
+                        finished = self.done
+                        subscriber.overflowed = False
+                    yield from missing
+                    subscriber.cursor += len(missing)
+                    if finished:
+                        yield from self._drain_finished(subscriber)
+                        return
+                    continue
+                item = subscriber.queue.get()
+                if item is _DONE:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                subscriber.cursor += 1
+                yield item
+        finally:
+            with self.lock:
+                if subscriber in self.subscribers:
+                    self.subscribers.remove(subscriber)
+
+    def _drain_finished(self, subscriber: _Subscriber) -> Iterator[Any]:
+        yield from self.chunks[subscriber.cursor:]
+        subscriber.cursor = len(self.chunks)
+        if self.error is not None:
+            raise self.error
+
+
+class SingleFlight:
+    """Registry of in-flight generations keyed by request fingerprint"""
+
+    def __init__(self, buffer_size: int = SINGLE_FLIGHT_BUFFER):
+        self.buffer_size = buffer_size
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+
+    def stream(self, key: str, factory: Callable[[], Iterator[Any]]) -> Iterator[Any]:
+        """Stream `factory()` once per key, fanning chunks out to every identical request"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight(key, self.buffer_size)
+            # Subscribe under the registry lock, so the producer cannot stop a flight being joined
+            stream = flight.subscribe()
+        FLIGHTS.inc(role="leader" if leader else "follower")
+        turn = telemetry.current_turn()
+        if turn:
+            turn.root.attributes["single_flight.follower"] = not leader
+        if leader:
+            # Produce under the leader's context so routing and tool spans attach to its turn
+            context = contextvars.copy_context()
+            threading.Thread(
+                target=context.run, args=(self._produce, flight, factory), name="single-flight", daemon=True
+            ).start()
+        return stream
+
+    def _produce(self, flight: Flight, factory: Callable[[], Iterator[Any]]):
+        error = None
+        stream = None
+        try:
+            stream = factory()
+            for chunk in stream:
+                flight.publish(chunk)
+                if self._abandon_if_unwatched(flight):
+                    ABANDONED.inc()
+                    break
+        except BaseException as e:
+            error = e
+        finally:
+            # Closing the generator closes the Bedrock stream
+            if hasattr(stream, "close"):
+                stream.close()
+            with self._lock:
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
+            flight.finish(error)
+
+    def _abandon_if_unwatched(self, flight: Flight) -> bool:
+        """Unregister `flight` if every subscriber has left, so no new request joins a stopped stream"""
+        if flight.subscribers:
+            return False
+        with self._lock:
+            with flight.lock:
+                if flight.subscribers:
+                    return False
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            return True
+
+
+SINGLE_FLIGHT = SingleFlight()
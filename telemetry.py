@@ -0,0 +1,406 @@
+# telemetry.py
+# Metrics and per-turn tracing for Bedrock ChatBot
+#
+# Metrics are exposed in Prometheus text format on METRICS_PORT (if set).
+# Spans are exported in OTLP/JSON to OTEL_EXPORTER_OTLP_ENDPOINT (if set) by a
+# background thread, so nothing here ever blocks the response stream.
+
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "bedrock-chatbot")
+
+# Latency buckets in seconds, tuned for LLM streaming (sub-second TTFT up to multi-minute answers)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class _Metric:
+    """Base class for labelled metrics"""
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Monotonic counter"""
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Cumulative histogram with fixed buckets"""
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # Layout: one count per bucket, then +Inf count, then sum
+            state = self._values.setdefault(key, [0.0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += 1
+            state[-1] += value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, state in self._values.items():
+                for bound, count in zip(self.buckets, state):
+                    labels = self._format_labels(key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = self._format_labels(key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {state[-2]}")
+                lines.append(f"{self.name}_sum{self._format_labels(key)} {state[-1]}")
+                lines.append(f"{self.name}_count{self._format_labels(key)} {state[-2]}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+REGISTRY: List[_Metric] = []
+
+
+def counter(name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+    metric = Counter(name, help_text, labelnames)
+    REGISTRY.append(metric)
+    return metric
+
+
+def histogram(name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+              buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+    metric = Histogram(name, help_text, labelnames, buckets=buckets)
+    REGISTRY.append(metric)
+    return metric
+
+
+def render_metrics() -> str:
+    """Render every registered metric in Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Chat turn metrics
+REQUESTS = counter("chatbot_requests_total", "Chat turns started", ("model", "role"))
+ERRORS = counter("chatbot_errors_total", "Chat turns that failed", ("model", "error"))
+THROTTLES = counter("chatbot_throttles_total", "Chat turns rejected by Bedrock throttling", ("model",))
+TOKENS = counter("chatbot_tokens_total", "Tokens reported by Bedrock", ("model", "direction"))
+TTFT = histogram("chatbot_time_to_first_token_seconds", "Time from request to first streamed token", ("model",))
+STAGE_DURATION = histogram("chatbot_stage_duration_seconds", "Duration of each chat turn stage", ("stage",))
+SPANS_DROPPED = counter("chatbot_spans_dropped_total", "Spans dropped because the export queue was full")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server_lock = threading.Lock()
+_metrics_server: Optional[ThreadingHTTPServer] = None
+
+
+def start_metrics_server(port: Optional[int] = None, addr: Optional[str] = None) -> Optional[ThreadingHTTPServer]:
+    """Start the /metrics endpoint once per process (no-op unless METRICS_PORT is set)"""
+    global _metrics_server
+    if port is None:
+        port = int(os.environ.get("METRICS_PORT", "0") or 0)
+    if not port:
+        return None
+    with _server_lock:
+        if _metrics_server is None:
+            addr = addr or os.environ.get("METRICS_ADDR", "0.0.0.0")
+            try:
+                _metrics_server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+            except OSError as e:
+                logger.warning("Could not start metrics server on %s:%s: %s", addr, port, e)
+                return None
+            threading.Thread(target=_metrics_server.serve_forever, name="metrics-server", daemon=True).start()
+    return _metrics_server
+
+
+class Span:
+    """A finished or in-progress span of a trace"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None,
+                 start_ns: Optional[int] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = dict(attributes or {})
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def end(self, end_ns: Optional[int] = None):
+        if self.end_ns is None:
+            self.end_ns = end_ns if end_ns is not None else time.time_ns()
+            STAGE_DURATION.observe(self.duration, stage=self.name)
+            _exporter.submit(self)
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class _SpanExporter:
+    """Batches finished spans and posts them to an OTLP/HTTP JSON collector off the request path"""
+
+    def __init__(self, max_queue: int = 2048, max_batch: int = 256, interval: float = 1.0):
+        self.max_batch = max_batch
+        self.interval = interval
+        self._queue: "queue.Queue[Span]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def endpoint(self) -> Optional[str]:
+        endpoint = os.environ.get("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")
+        if endpoint:
+            return endpoint
+        base = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+        return base.rstrip("/") + "/v1/traces" if base else None
+
+    def submit(self, span: Span):
+        if not self.endpoint:
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            SPANS_DROPPED.inc()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._post(batch)
+
+    def _post(self, batch: List[Span]):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": "bedrock-chatbot"}, "spans": [s.to_otlp() for s in batch]}],
+            }]
+        }
+        request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        try:
+            urllib.request.urlopen(request, timeout=5).close()
+        except Exception as e:
+            SPANS_DROPPED.inc(len(batch))
+            logger.debug("Span export failed: %s", e)
+
+
+_exporter = _SpanExporter()
+
+
+def error_code(exc: BaseException) -> str:
+    """Return the Bedrock error code for botocore errors, otherwise the exception class name"""
+    response = getattr(exc, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code")
+        if code:
+            return code
+    return type(exc).__name__
+
+
+class Turn:
+    """Trace of a single chat turn: history build, prompt formatting, Bedrock connect,
+    first token, stream and render"""
+
+    def __init__(self, model: str, role: str):
+        self.model = model
+        self.role = role
+        self.root = Span("chat.turn", uuid.uuid4().hex, attributes={"model": model, "role": role})
+        self._request_ns: Optional[int] = None
+        self._connect_ns: Optional[int] = None
+        self._first_token_ns: Optional[int] = None
+        self._token: Optional[contextvars.Token] = None
+        REQUESTS.inc(model=model, role=role)
+
+    @contextmanager
+    def stage(self, name: str, **attributes):
+        span = Span(name, self.root.trace_id, self.root.span_id, attributes=attributes)
+        try:
+            yield span
+        except Exception as e:
+            span.error = error_code(e)
+            raise
+        finally:
+            span.end()
+
+    def record_span(self, name: str, start_ns: int, end_ns: Optional[int] = None, **attributes):
+        """Record a finished stage that was timed outside a `stage` block"""
+        Span(name, self.root.trace_id, self.root.span_id, start_ns=start_ns, attributes=attributes).end(end_ns)
+
+    def request_sent(self):
+        self._request_ns = time.time_ns()
+
+    def chunk_received(self, at_ns: Optional[int] = None):
+        """Called for every raw chunk; the first one closes the connect stage.
+
+        The router passes `at_ns`, the arrival of the first raw event, since it holds
+        chunks back until the first content chunk to decide on failover.
+        """
+        if self._connect_ns is None and self._request_ns is not None:
+            self._connect_ns = at_ns or time.time_ns()
+            Span("bedrock.connect", self.root.trace_id, self.root.span_id, start_ns=self._request_ns).end(self._connect_ns)
+
+    def token_received(self):
+        """Called for every text delta; the first one closes the first-token stage"""
+        if self._first_token_ns is None and self._request_ns is not None:
+            self._first_token_ns = time.time_ns()
+            span = Span("bedrock.first_token", self.root.trace_id, self.root.span_id, start_ns=self._request_ns)
+            span.end(self._first_token_ns)
+            TTFT.observe(span.duration, model=self.model)
+
+    def record_usage(self, usage: Optional[Dict[str, Any]]):
+        # Turns that joined another turn's generation did not consume tokens of their own
+        if not usage or self.root.attributes.get("single_flight.follower"):
+            return
+        for direction in ("input_tokens", "output_tokens"):
+            if usage.get(direction):
+                TOKENS.inc(usage[direction], model=self.model, direction=direction.split("_")[0])
+                self.root.attributes[f"gen_ai.usage.{direction}"] = usage[direction]
+        details = usage.get("input_token_details") or {}
+        for detail, direction in (("cache_read", "cache_read"), ("cache_creation", "cache_write")):
+            if details.get(detail):
+                TOKENS.inc(details[detail], model=self.model, direction=direction)
+                self.root.attributes[f"gen_ai.usage.{direction}_tokens"] = details[detail]
+
+    def fail(self, exc: BaseException):
+        code = error_code(exc)
+        self.root.error = code
+        ERRORS.inc(model=self.model, error=code)
+        if "Throttl" in code or "TooManyRequests" in code:
+            THROTTLES.inc(model=self.model)
+
+    def finish(self):
+        if self._first_token_ns is not None:
+            Span("bedrock.stream", self.root.trace_id, self.root.span_id, start_ns=self._first_token_ns).end()
+        self.root.end()
+        if self._token is not None:
+            _current_turn.reset(self._token)
+            self._token = None
+
+
+_current_turn: contextvars.ContextVar[Optional[Turn]] = contextvars.ContextVar("current_turn", default=None)
+
+
+def start_turn(model: str, role: str) -> Turn:
+    """Start tracing a chat turn and make it the current turn for this context"""
+    turn = Turn(model, role)
+    turn._token = _current_turn.set(turn)
+    return turn
+
+
+def current_turn() -> Optional[Turn]:
+    return _current_turn.get()
@@ -0,0 +1,91 @@
+# token_budget.py
+# Adaptive max_tokens from observed answer lengths
+#
+# Bedrock reserves tokens-per-minute quota against max_tokens when a request
+# starts, so a large default limit lowers how many requests can run at once.
+# The budget model learns per (role, model) how long answers actually are and
+# predicts a max_tokens with a safety margin; for roles whose answers scale with
+# the input (translation, editing) it also learns the output/query ratio.
+# Answers that still stop at the limit are continued with assistant prefill, so
+# a low prediction costs a round trip, never a truncated answer.
+
+import os
+import threading
+from collections import deque
+from typing import Deque, Dict, Tuple
+
+import telemetry
+
+ADAPTIVE_MAX_TOKENS = os.environ.get("ADAPTIVE_MAX_TOKENS", "0") == "1"
+BUDGET_MARGIN = float(os.environ.get("BUDGET_MARGIN", "1.3"))
+BUDGET_MIN_TOKENS = int(os.environ.get("BUDGET_MIN_TOKENS", "512"))
+BUDGET_DEFAULT_TOKENS = int(os.environ.get("BUDGET_DEFAULT_TOKENS", "2048"))
+MAX_CONTINUATIONS = int(os.environ.get("MAX_CONTINUATIONS", "3"))
+
+# Observations kept per (role, model), and needed before predictions replace the default
+BUDGET_SAMPLES = 200
+BUDGET_MIN_SAMPLES = 5
+# Quantile of observed lengths the budget covers before the margin is applied
+BUDGET_QUANTILE = 0.9
+
+RESERVED_TOKENS = telemetry.counter("chatbot_reserved_tokens_total", "max_tokens reserved by requests", ("model",))
+RESERVED_TOKENS_SAVED = telemetry.counter(
+    "chatbot_reserved_tokens_saved_total", "Reserved max_tokens avoided by adaptive budgets", ("model",)
+)
+CONTINUATIONS = telemetry.counter(
+    "chatbot_max_tokens_continuations_total", "Answers continued after stopping at max_tokens", ("model",)
+)
+
+
+def quantile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class OutputLengthModel:
+    """Rolling answer lengths per (role, model) and the max_tokens they predict"""
+
+    def __init__(self, samples: int = BUDGET_SAMPLES):
+        self.samples = samples
+        self._observations: Dict[Tuple[str, str], Deque[Tuple[int, int]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, role: str, model: str, query_tokens: int, output_tokens: int):
+        if output_tokens <= 0:
+            return
+        with self._lock:
+            observations = self._observations.setdefault((role, model), deque(maxlen=self.samples))
+            observations.append((max(1, query_tokens), output_tokens))
+
+    def predict(self, role: str, model: str, query_tokens: int, limit: int, scales_with_input: bool = False) -> int:
+        """max_tokens for a query of `query_tokens`, never above the configured `limit`.
+
+        Only roles whose answer length follows the input (`scales_with_input`) use the
+        output/query ratio; for the others a few short queries with long answers would
+        inflate the ratio and push ordinary queries to the limit.
+        """
+        with self._lock:
+            observations = list(self._observations.get((role, model), ()))
+        if len(observations) < BUDGET_MIN_SAMPLES:
+            expected = max(BUDGET_DEFAULT_TOKENS, query_tokens) if scales_with_input else BUDGET_DEFAULT_TOKENS
+        else:
+            expected = quantile([output for _, output in observations], BUDGET_QUANTILE)
+            if scales_with_input:
+                ratio = quantile([output / query for query, output in observations], BUDGET_QUANTILE)
+                expected = max(expected, ratio * query_tokens)
+        return int(min(limit, max(BUDGET_MIN_TOKENS, expected * BUDGET_MARGIN)))
+
+
+def record_reservation(model: str, reserved: int, limit: int):
+    """Count quota reserved by one request and what the fixed limit would have reserved"""
+    RESERVED_TOKENS.inc(reserved, model=model)
+    saved = max(0, limit - reserved)
+    RESERVED_TOKENS_SAVED.inc(saved, model=model)
+    turn = telemetry.current_turn()
+    if turn:
+        attributes = turn.root.attributes
+        attributes["max_tokens.reserved"] = attributes.get("max_tokens.reserved", 0) + reserved
+        attributes["max_tokens.saved"] = attributes.get("max_tokens.saved", 0) + saved
+
+
+OUTPUT_LENGTHS = OutputLengthModel()
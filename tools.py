@@ -0,0 +1,209 @@
+# tools.py
+# Tool registry and parallel tool execution for Bedrock ChatBot
+#
+# Tools run against a local, read-only analytics dataset (SQLite, or DuckDB if
+# installed) configured with ANALYTICS_DB_PATH. Tool calls from one model turn
+# run in parallel on a shared worker pool, with a timeout and a result-size cap
+# so tool output cannot blow up the context. Queries are aborted at the timeout
+# (SQLite progress handler, DuckDB interrupt), so a hung query cannot keep a
+# pool worker busy after its result has been given up on.
+
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+from langchain_core.messages import ToolMessage
+from langchain_core.tools import BaseTool, tool
+
+import profiling
+import telemetry
+
+ANALYTICS_DB_PATH = os.environ.get("ANALYTICS_DB_PATH", "")
+TOOL_TIMEOUT = float(os.environ.get("TOOL_TIMEOUT", "20"))
+TOOL_MAX_ROWS = int(os.environ.get("TOOL_MAX_ROWS", "200"))
+TOOL_MAX_RESULT_CHARS = int(os.environ.get("TOOL_MAX_RESULT_CHARS", "8000"))
+TOOL_WORKERS = int(os.environ.get("TOOL_WORKERS", "4"))
+
+TOOL_CALLS = telemetry.counter("chatbot_tool_calls_total", "Tool calls executed", ("tool", "outcome"))
+TOOL_DURATION = telemetry.histogram("chatbot_tool_duration_seconds", "Tool call duration", ("tool",))
+
+_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+
+
+class ToolError(Exception):
+    """Error reported back to the model as a failed tool result"""
+
+
+def dataset_available() -> bool:
+    return bool(ANALYTICS_DB_PATH) and os.path.exists(ANALYTICS_DB_PATH)
+
+
+def _connect(deadline: float):
+    """Open the dataset read-only; queries are aborted once `deadline` passes (see _query for DuckDB)"""
+    if ANALYTICS_DB_PATH.endswith(".duckdb"):
+        import duckdb
+        # read_only only protects the database file: also block table functions that read
+        # local files or URLs (read_text, read_csv, ...), and stop SQL from re-enabling them
+        return duckdb.connect(ANALYTICS_DB_PATH, read_only=True,
+                              config={"enable_external_access": False, "lock_configuration": True})
+    conn = sqlite3.connect(f"file:{ANALYTICS_DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    conn.set_progress_handler(lambda: int(time.monotonic() > deadline), 10000)
+    return conn
+
+
+def _query(sql: str, max_rows: int = TOOL_MAX_ROWS) -> pd.DataFrame:
+    """Run one read-only statement and return at most `max_rows` + 1 rows"""
+    statement = sql.strip().rstrip(";")
+    if not statement.lower().startswith(("select", "with", "pragma table_info", "describe", "show")):
+        raise ToolError("Only read-only SELECT queries are allowed")
+    conn = _connect(time.monotonic() + TOOL_TIMEOUT)
+    timer = None
+    if ANALYTICS_DB_PATH.endswith(".duckdb"):
+        # DuckDB has no progress handler: interrupt the running query from a timer instead
+        timer = threading.Timer(TOOL_TIMEOUT, conn.interrupt)
+        timer.daemon = True
+        timer.start()
+    try:
+        cursor = conn.execute(statement)
+        columns = [d[0] for d in cursor.description or []]
+        rows = cursor.fetchmany(max_rows + 1)
+    except Exception as e:
+        raise ToolError(f"Query failed: {e}") from e
+    finally:
+        if timer:
+            timer.cancel()
+        conn.close()
+    return pd.DataFrame(rows, columns=columns)
+
+
+def _format_frame(df: pd.DataFrame, max_rows: int = TOOL_MAX_ROWS) -> str:
+    truncated = len(df) > max_rows
+    text = df.head(max_rows).to_csv(index=False)
+    if truncated:
+        text += f"... (truncated to {max_rows} rows)\n"
+    return text
+
+
+@tool
+def list_tables() -> str:
+    """List the tables and columns available in the local analytics dataset."""
+    if ANALYTICS_DB_PATH.endswith(".duckdb"):
+        df = _query("SELECT table_name, column_name, data_type FROM information_schema.columns "
+                    "ORDER BY table_name, ordinal_position", max_rows=1000)
+    else:
+        tables = _query("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') ORDER BY name",
+                        max_rows=1000)["name"]
+        frames = []
+        for name in tables:
+            info = _query(f"PRAGMA table_info('{name}')", max_rows=1000)
+            frames.append(pd.DataFrame({"table_name": name, "column_name": info["name"], "data_type": info["type"]}))
+        df = pd.concat(frames) if frames else pd.DataFrame(columns=["table_name", "column_name", "data_type"])
+    return _format_frame(df, max_rows=1000)
+
+
+@tool
+def run_sql(query: str) -> str:
+    """Run a read-only SQL SELECT query against the local analytics dataset and return the rows as CSV.
+
+    Args:
+        query: A single SELECT (or WITH ... SELECT) statement.
+    """
+    return _format_frame(_query(query))
+
+
+@tool
+def compute_metrics(query: str, metrics: Dict[str, str], group_by: Optional[List[str]] = None) -> str:
+    """Aggregate the rows of a SQL query with pandas and compute derived metrics.
+
+    Numeric columns are summed (per group if group_by is given), then each metric
+    expression is evaluated with pandas DataFrame.eval on the aggregated columns,
+    e.g. {"ctr": "clicks / impressions", "cpa": "spend / conversions"}.
+
+    Args:
+        query: A SELECT statement returning the raw rows to aggregate.
+        metrics: Mapping of metric name to a pandas eval expression over the summed columns.
+        group_by: Optional list of columns to group by before aggregating.
+    """
+    df = _query(query, max_rows=100000)
+    if group_by:
+        missing = [c for c in group_by if c not in df.columns]
+        if missing:
+            raise ToolError(f"Unknown group_by columns: {', '.join(missing)}")
+        aggregated = df.groupby(group_by).sum(numeric_only=True).reset_index()
+    else:
+        aggregated = df.sum(numeric_only=True).to_frame().T
+    for name, expression in metrics.items():
+        try:
+            aggregated[name] = aggregated.eval(expression)
+        except Exception as e:
+            raise ToolError(f"Could not evaluate metric {name!r}: {e}") from e
+    return _format_frame(aggregated)
+
+
+TOOL_REGISTRY: Dict[str, BaseTool] = {t.name: t for t in (list_tables, run_sql, compute_metrics)}
+
+
+def get_tools(names: Optional[List[str]]) -> List[BaseTool]:
+    """Resolve tool names for a role; empty when no dataset is configured"""
+    if not names or not dataset_available():
+        return []
+    return [TOOL_REGISTRY[name] for name in names if name in TOOL_REGISTRY]
+
+
+def _truncate(text: str, limit: int = TOOL_MAX_RESULT_CHARS) -> str:
+    if len(text) <= limit:
+        return text
+    return text[:limit] + f"\n... (truncated {len(text) - limit:,} characters)"
+
+
+def _invoke(tool_obj: BaseTool, args: Dict[str, Any]) -> str:
+    turn = telemetry.current_turn()
+    start = time.monotonic()
+    try:
+        with profiling.attach_thread():
+            if turn:
+                with turn.stage(f"tool.{tool_obj.name}"):
+                    return str(tool_obj.invoke(args))
+            return str(tool_obj.invoke(args))
+    finally:
+        TOOL_DURATION.observe(time.monotonic() - start, tool=tool_obj.name)
+
+
+def run_tool_calls(tool_calls: List[Dict[str, Any]], tools: List[BaseTool],
+                   timeout: float = TOOL_TIMEOUT) -> List[ToolMessage]:
+    """Execute the tool calls of one model turn in parallel and return their results in order"""
+    by_name = {t.name: t for t in tools}
+    futures = []
+    for call in tool_calls:
+        tool_obj = by_name.get(call["name"])
+        if tool_obj is None:
+            futures.append(None)
+            continue
+        context = contextvars.copy_context()
+        futures.append(_executor.submit(context.run, _invoke, tool_obj, call.get("args") or {}))
+
+    deadline = time.monotonic() + timeout
+    results = []
+    for call, future in zip(tool_calls, futures):
+        status, outcome = "error", "error"
+        if future is None:
+            content = f"Unknown tool: {call['name']}"
+            outcome = "unknown"
+        else:
+            try:
+                content = _truncate(future.result(timeout=max(0.0, deadline - time.monotonic())))
+                status, outcome = "success", "ok"
+            except FutureTimeoutError:
+                future.cancel()
+                content = f"Tool timed out after {timeout:.0f}s"
+                outcome = "timeout"
+            except Exception as e:
+                content = _truncate(f"Tool failed: {e}")
+        TOOL_CALLS.inc(tool=call["name"], outcome=outcome)
+        results.append(ToolMessage(content=content, tool_call_id=call["id"], name=call["name"], status=status))
+    return results
@@ -0,0 +1,252 @@
+# translation_memory.py
+# Segment-level translation memory for the Translator role
+#
+# Input is split into segments (lines, then sentences). Each segment is looked
+# up in a local SQLite store keyed by language pair: first as an exact match,
+# then by its normalized form (Unicode, case and whitespace folded) so
+# near-duplicates are reused too. Only the missing segments go to the model, in
+# batches sized so each reply fits in max_tokens; segments a reply leaves out are
+# requested once more. The output is rebuilt in the original layout.
+
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Callable, Dict, List, Optional, Tuple
+
+import longinput
+import telemetry
+
+TRANSLATION_MEMORY_PATH = os.environ.get("TRANSLATION_MEMORY_PATH", "./data/translation_memory.db")
+
+LANGUAGES = [
+    "English", "Traditional Chinese", "Simplified Chinese", "Japanese", "Korean", "Spanish", "French",
+    "German", "Portuguese", "Italian", "Vietnamese", "Thai", "Indonesian",
+]
+AUTO_DETECT = "Auto-detect"
+
+TM_SEGMENTS = telemetry.counter(
+    "chatbot_translation_memory_segments_total", "Translated segments by memory outcome", ("outcome",)
+)
+
+# Lines, then sentence ends (Latin and CJK punctuation); separators are kept for the rebuild
+SEGMENT_PATTERN = re.compile(r"(\n+|(?<=[.!?。！？])[ \t]+|(?<=[。！？]))")
+BATCH_PATTERN = re.compile(r'<s id="(\d+)">(.*?)</s>', re.DOTALL)
+
+# Reply tokens budgeted per segment: its <s id="N"></s> tags, plus twice the source length
+# since a translation can take more tokens than its source (e.g. English to CJK)
+SEGMENT_TAG_TOKENS = 8
+TRANSLATION_TOKEN_RATIO = 2
+# Rounds of batches; later rounds re-request segments missing from earlier replies
+BATCH_ROUNDS = 2
+
+BATCH_PROMPT = """Translate each segment below {direction}. Segments may be fragments of the same document, so keep terminology consistent between them.
+Reply with every segment in the same <s id="N">...</s> format, in the same order, and nothing else.
+
+{segments}"""
+
+
+def normalize(segment: str) -> str:
+    """Key for near-duplicate lookup: NFKC, case-folded, whitespace collapsed"""
+    return " ".join(unicodedata.normalize("NFKC", segment).casefold().split())
+
+
+def split_segments(text: str) -> Tuple[List[str], List[int]]:
+    """Split `text` into pieces; return the pieces and the indices of translatable segments.
+
+    Joining the pieces gives back `text`, so replacing the segment pieces with their
+    translations rebuilds the output in the original layout.
+    """
+    pieces: List[str] = []
+    segments: List[int] = []
+    for i, piece in enumerate(SEGMENT_PATTERN.split(text)):
+        if i % 2 or not piece.strip():
+            pieces.append(piece)
+            continue
+        # Keep surrounding whitespace (indentation, trailing spaces) out of the segment
+        core = piece.strip()
+        start = piece.index(core)
+        pieces.append(piece[:start])
+        segments.append(len(pieces))
+        pieces.append(core)
+        pieces.append(piece[start + len(core):])
+    return pieces, segments
+
+
+def build_batch_prompt(segments: List[str], source: str, target: str) -> str:
+    direction = f"to {target}" if source == AUTO_DETECT else f"from {source} to {target}"
+    body = "\n".join(f'<s id="{i + 1}">{segment}</s>' for i, segment in enumerate(segments))
+    return BATCH_PROMPT.format(direction=direction, segments=body)
+
+
+def plan_batches(segments: List[str], max_tokens: int) -> List[List[str]]:
+    """Group segments in order so the expected reply to each batch fits in `max_tokens`"""
+    batches: List[List[str]] = []
+    batch: List[str] = []
+    used = 0
+    for segment in segments:
+        cost = longinput.estimate_tokens(segment) * TRANSLATION_TOKEN_RATIO + SEGMENT_TAG_TOKENS
+        if batch and used + cost > max_tokens:
+            batches.append(batch)
+            batch, used = [], 0
+        batch.append(segment)
+        used += cost
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def parse_batch_response(text: str, count: int) -> List[Optional[str]]:
+    """Translations by position; segments missing from the reply are None"""
+    results: List[Optional[str]] = [None] * count
+    for number, translation in BATCH_PATTERN.findall(text):
+        index = int(number) - 1
+        if 0 <= index < count and translation.strip():
+            results[index] = translation.strip()
+    return results
+
+
+class TranslationMemory:
+    """SQLite store of translated segments, indexed by language pair and normalized text"""
+
+    def __init__(self, path: str = TRANSLATION_MEMORY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        if not self._initialized:
+            with self._lock:
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS segments (
+                        source_lang TEXT NOT NULL,
+                        target_lang TEXT NOT NULL,
+                        source TEXT NOT NULL,
+                        normalized TEXT NOT NULL,
+                        target TEXT NOT NULL,
+                        hits INTEGER NOT NULL DEFAULT 0,
+                        updated REAL NOT NULL,
+                        PRIMARY KEY (source_lang, target_lang, source)
+                    );
+                    CREATE INDEX IF NOT EXISTS segments_normalized
+                        ON segments (source_lang, target_lang, normalized);
+                """)
+                self._initialized = True
+        return conn
+
+    def lookup(self, source_lang: str, target_lang: str, segments: List[str]) -> Dict[str, Tuple[str, str]]:
+        """Map each known segment to (translation, "exact" or "near")"""
+        found: Dict[str, Tuple[str, str]] = {}
+        conn = self._connect()
+        try:
+            for segment in set(segments):
+                row = conn.execute(
+                    "SELECT target FROM segments WHERE source_lang = ? AND target_lang = ? AND source = ?",
+                    (source_lang, target_lang, segment),
+                ).fetchone()
+                kind = "exact"
+                if row is None:
+                    row = conn.execute(
+                        "SELECT target FROM segments WHERE source_lang = ? AND target_lang = ? AND normalized = ? "
+                        "ORDER BY hits DESC, updated DESC LIMIT 1",
+                        (source_lang, target_lang, normalize(segment)),
+                    ).fetchone()
+                    kind = "near"
+                if row is not None:
+                    found[segment] = (row[0], kind)
+            if found:
+                with conn:
+                    conn.executemany(
+                        "UPDATE segments SET hits = hits + 1 WHERE source_lang = ? AND target_lang = ? AND source = ?",
+                        [(source_lang, target_lang, segment) for segment, (_, kind) in found.items() if kind == "exact"],
+                    )
+        finally:
+            conn.close()
+        return found
+
+    def store(self, source_lang: str, target_lang: str, translations: Dict[str, str]):
+        if not translations:
+            return
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO segments (source_lang, target_lang, source, normalized, target, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(source_lang, target_lang, source, normalize(source), target, now)
+                     for source, target in translations.items()],
+                )
+        finally:
+            conn.close()
+
+    def size(self, source_lang: str, target_lang: str) -> int:
+        if not self.enabled or not os.path.exists(self.path):
+            return 0
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "SELECT COUNT(*) FROM segments WHERE source_lang = ? AND target_lang = ?", (source_lang, target_lang)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+
+    def translate(self, text: str, source_lang: str, target_lang: str,
+                  translate_batch: Callable[[List[str]], List[Optional[str]]],
+                  max_tokens: int) -> Tuple[str, Dict[str, int]]:
+        """Translate `text`, sending only segments missing from memory to `translate_batch`
+        in batches whose replies fit in `max_tokens`.
+
+        Returns the rebuilt translation and counts of segments by outcome
+        (exact, near, translated, failed; failed segments are left untranslated).
+        """
+        pieces, positions = split_segments(text)
+        segments = [pieces[i] for i in positions]
+        found = self.lookup(source_lang, target_lang, segments)
+
+        missing = list(dict.fromkeys(s for s in segments if s not in found))
+        translated: Dict[str, str] = {}
+        for _ in range(BATCH_ROUNDS):
+            pending = [s for s in missing if s not in translated]
+            for batch in plan_batches(pending, max_tokens):
+                results = {
+                    segment: translation
+                    for segment, translation in zip(batch, translate_batch(batch)) if translation is not None
+                }
+                # Stored per batch, so a failure in a later batch keeps the earlier ones
+                self.store(source_lang, target_lang, results)
+                translated.update(results)
+
+        stats = {"segments": len(segments), "exact": 0, "near": 0, "translated": 0, "failed": 0}
+        for i, segment in zip(positions, segments):
+            if segment in found:
+                pieces[i], outcome = found[segment]
+            elif segment in translated:
+                pieces[i], outcome = translated[segment], "translated"
+            else:
+                outcome = "failed"
+            stats[outcome] += 1
+            TM_SEGMENTS.inc(outcome=outcome)
+        return "".join(pieces), stats
+
+
+def format_stats(stats: Dict[str, int]) -> str:
+    """One-line memory hit rate for display"""
+    total = max(1, stats["segments"])
+    hits = stats["exact"] + stats["near"]
+    text = (f"📚 Translation memory: {hits}/{total} segments reused ({hits / total:.0%}; "
+            f"{stats['exact']} exact, {stats['near']} near) • {stats['translated']} translated")
+    if stats["failed"]:
+        text += f" • ⚠️ {stats['failed']} left untranslated"
+    return text
+
+
+TRANSLATION_MEMORY = TranslationMemory()